@@ -65,20 +65,28 @@ def initialize(module_name=None):
     )
 
     ss = get_config('session_store', None)
-    if ss:
+    if hasattr(ss, 'lower'):
         class_ = switchout_keyvalue(ss)
         setattr(giotto._config, "session_store", class_())
 
     cache_engine = get_config("cache", None)
     if hasattr(cache_engine, 'lower'):
-        # session engine was passed in as string, exchange for engine object.
+        # cache engine was passed in as string, exchange for engine object.
+        # `cache_options` are passed on to the engine's constructor,
+        # eg: {'max_connections': 20, 'socket_timeout': 0.5}
         class_ = switchout_keyvalue(cache_engine)
-        e = class_(host=get_config("cache_host", "localhost"))
+        e = class_(
+            host=get_config("cache_host", "localhost"),
+            **get_config("cache_options", {})
+        )
         setattr(giotto._config, "cache_engine", e)
+    elif cache_engine:
+        setattr(giotto._config, "cache_engine", cache_engine)
 
 def get_config(item, default=None):
     """
     Use this function to get values from the config object.
     """
     import giotto
-    return getattr(giotto._config, item, default) or default
\ No newline at end of file
+    config = getattr(giotto, '_config', None) # None before `initialize` is called
+    return getattr(config, item, default) or default
\ No newline at end of file
@@ -0,0 +1,80 @@
+"""
+Thin client for the command line controller daemon (see
+giotto.controllers.cmd.serve_daemon). It hands its argv, environment,
+working directory, and its stdin, stdout and stderr file descriptors to the
+daemon, which runs the program in an already initialized process.
+This module is imported before anything else in the concrete controller,
+so it must stay light: standard library only.
+"""
+import array
+import json
+import os
+import socket
+import struct
+import sys
+
+def send_invocation(sock, argv, env, cwd, fds=(0, 1, 2)):
+    header = json.dumps({'argv': argv, 'env': env, 'cwd': cwd}).encode('utf-8')
+    sock.sendmsg(
+        [struct.pack('!I', len(header))],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+    )
+    sock.sendall(header)
+
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def recv_invocation(sock):
+    """
+    Returns the invocation (a dict with argv, env and cwd) and the
+    stdin, stdout and stderr file descriptors sent by `send_invocation`.
+    """
+    fds = array.array('i')
+    data, ancdata, flags, address = sock.recvmsg(4, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, type, payload in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - (len(payload) % fds.itemsize)])
+    if len(data) < 4:
+        data += recv_exactly(sock, 4 - len(data)) or b''
+    header = recv_exactly(sock, struct.unpack('!I', data)[0])
+    return json.loads(header.decode('utf-8')), list(fds)
+
+def run_through_daemon(argv, socket_path):
+    """
+    If the daemon is listening on `socket_path`, have it run the invocation
+    in `argv` and exit with the program's exit code. If there is no daemon
+    (or `argv` is the command to start one), return, so the invocation
+    runs in this process as usual.
+    """
+    if '--daemon' in argv or not hasattr(socket, 'AF_UNIX') or not hasattr(socket.socket, 'sendmsg'):
+        return
+    if not os.path.exists(socket_path):
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        # stale socket file, the daemon is not running
+        sock.close()
+        return
+
+    try:
+        send_invocation(sock, list(argv), dict(os.environ), os.getcwd())
+        status = recv_exactly(sock, 4)
+    except KeyboardInterrupt:
+        # closing the connection tells the daemon to interrupt the program
+        sock.close()
+        sys.exit(130)
+
+    sock.close()
+    if status is None:
+        sys.stderr.write("giotto: the cmd daemon hung up without an exit code\n")
+        sys.exit(1)
+    sys.exit(struct.unpack('!i', status)[0])
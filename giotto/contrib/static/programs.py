@@ -1,13 +1,135 @@
 import os
+import re
+import json
+import shutil
+import hashlib
 import mimetypes
 
 from giotto import get_config
 from giotto.programs import Program
 from giotto.views import GiottoView, renders
-from giotto.utils import super_accept_to_mimetype
+from giotto.utils import super_accept_to_mimetype, is_compressible, compress, compress_encodings
 from giotto.exceptions import DataNotFound
 from giotto.primitives import RAW_INVOCATION_ARGS
 
+mimetype_cache = {}
+
+manifest_name = 'staticfiles.json'
+immutable_cache_control = 'public, max-age=31536000, immutable'
+fingerprinted = re.compile(r'\.[0-9a-f]{12}(\.[^.]*)?$')
+
+# encodings a precompressed sibling can have, in order of preference.
+precompressed_suffixes = [('br', '.br'), ('gzip', '.gz')]
+
+def guess_mimetype(path):
+    """
+    Cached version of `mimetypes.guess_type`. Results are cached by the
+    file's extension(s).
+    """
+    extension = os.path.basename(path).partition('.')[2].lower()
+    try:
+        return mimetype_cache[extension]
+    except KeyError:
+        mime, encoding = mimetypes.guess_type(path)
+        mimetype_cache[extension] = mime or 'application/octet-stream'
+        return mimetype_cache[extension]
+
+def find_precompressed(fullpath, mtime):
+    """
+    Returns a dict of encoding -> path of every precompressed sibling of
+    the file at `fullpath` (made by `build_static`). Siblings older than
+    the file's modification time `mtime` were made from an older version
+    of the file, and are left out.
+    """
+    variants = {}
+    for encoding, suffix in precompressed_suffixes:
+        try:
+            if os.path.getmtime(fullpath + suffix) >= mtime:
+                variants[encoding] = fullpath + suffix
+        except OSError:
+            pass # no such sibling
+    return variants
+
+asset_manifests = {}
+
+def get_asset_manifest(root):
+    """
+    Load the manifest written by `build_static` into the `root` static
+    directory. The result is cached until the manifest file changes.
+    Returns a dict of original path -> fingerprinted path, and a set of all
+    the fingerprinted paths.
+    """
+    path = os.path.join(root, manifest_name)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}, set()
+
+    cached = asset_manifests.get(path)
+    if not cached or cached[0] != mtime:
+        with open(path) as f:
+            manifest = json.load(f)
+        cached = asset_manifests[path] = (mtime, manifest, set(manifest.values()))
+    return cached[1], cached[2]
+
+def static_url(path, base_path='/views/static/', prefix='/static/'):
+    """
+    Returns the url of the fingerprinted version of the static file at `path`.
+    Falls back to the plain url when `build_static` has not been run.
+    """
+    manifest, hashed = get_asset_manifest(get_config('project_path') + base_path)
+    return prefix + manifest.get(path, path)
+
+def build_static(base_path='/views/static/', min_size=256):
+    """
+    Copy every file in the static directory to a fingerprinted name
+    (`site.css` -> `site.<hash>.css`), write gzip (and brotli, if installed)
+    compressed versions next to each compressible file, and write a manifest
+    mapping the original names to the fingerprinted ones.
+    Run this once per deploy, after the static files change.
+    """
+    root = get_config('project_path') + base_path
+    min_size = int(min_size)
+    manifest = {}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if (filename == manifest_name or filename.startswith('.')
+                    or filename.endswith(('.gz', '.br')) or fingerprinted.search(filename)):
+                # output of a previous build
+                continue
+
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, root).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                content = f.read()
+
+            name, extension = os.path.splitext(relpath)
+            digest = hashlib.md5(content).hexdigest()[:12]
+            manifest[relpath] = "%s.%s%s" % (name, digest, extension)
+            hashed_path = os.path.join(root, manifest[relpath])
+            if not os.path.exists(hashed_path):
+                shutil.copy2(path, hashed_path)
+
+            compressible = len(content) >= min_size and is_compressible(guess_mimetype(path))
+            for encoding, suffix in precompressed_suffixes:
+                compressed = None
+                if compressible and encoding in compress_encodings:
+                    compressed = compress(content, encoding, level=11)
+                for target in (path, hashed_path):
+                    if compressed and len(compressed) < len(content):
+                        with open(target + suffix, 'wb') as f:
+                            f.write(compressed)
+                    elif os.path.exists(target + suffix):
+                        # left over from a build of an older version of the file,
+                        # compressing doesn't help anymore.
+                        os.remove(target + suffix)
+
+    with open(os.path.join(root, manifest_name), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    return manifest
+
 class FileView(GiottoView):
 
     def render(self, result, mimetype, errors):
@@ -15,23 +137,35 @@ class FileView(GiottoView):
 
     @renders('*/*')
     def any(self, result):
-        return {'body': result[0], 'mimetype': result[1]}
+        response = {'body': result[0], 'mimetype': result[1]}
+        if len(result) > 2:
+            # precompressed versions of the file, the http controller picks
+            # one based on the request's Accept-Encoding header.
+            response['encodings'], immutable = result[2:]
+            if immutable:
+                response['cache_control'] = immutable_cache_control
+        return response
 
     @renders('text/x-cmd')
     def cmd(self, result):
-        return {'body': result.read(), 'mimetype': ''}
+        return {'body': result[0].read(), 'mimetype': ''}
 
 def StaticServe(base_path='/views/static/'):
     """
-    Meta program for serving any file based on the path
+    Meta program for serving any file based on the path. Files that have
+    been fingerprinted by `build_static` are served with far future
+    cache headers.
     """
     def get_file(path=RAW_INVOCATION_ARGS):
+        root = get_config('project_path') + base_path
         fullpath = get_config('project_path') + os.path.join(base_path, path)
         try:
-            mime, encoding = mimetypes.guess_type(fullpath)
-            return open(fullpath, 'rb'), mime or 'application/octet-stream'
+            file = open(fullpath, 'rb')
         except IOError:
             raise DataNotFound("File does not exist")
+        manifest, hashed = get_asset_manifest(root)
+        encodings = find_precompressed(fullpath, os.fstat(file.fileno()).st_mtime)
+        return file, guess_mimetype(fullpath), encodings, path in hashed
 
     class StaticServe(Program):
         controllers = ['http-get']
@@ -45,9 +179,8 @@ def SingleStaticServe(file_path):
     Meta program for serving a single file. Useful for favicon.ico and robots.txt
     """
     def get_file():
-        mime, encoding = mimetypes.guess_type(file_path)
         fullpath = os.path.join(get_config('project_path'), file_path)
-        return open(fullpath, 'rb'), mime or 'application/octet-stream'
+        return open(fullpath, 'rb'), guess_mimetype(file_path)
 
     class SingleStaticServe(Program):
         controllers = ['http-get']
@@ -1,18 +1,24 @@
 from collections import deque
 import inspect
-import json
+import time
 
 from giotto import get_config
 
 from giotto.exceptions import (GiottoException, InvalidInput, ProgramNotFound,
     MockNotFound, ControlMiddlewareInterrupt, NotAuthorized, InvalidInvocation)
 from giotto.primitives import GiottoPrimitive, RAW_INVOCATION_ARGS
-from giotto.keyvalue import DummyKeyValue
+from giotto.keyvalue import (DummyKeyValue, single_flight, refresh_in_background,
+    get_tag_generations)
 from giotto.control import GiottoControl
+from giotto.utils import make_digest, make_etag, is_stream, encode_chunks
 
 class GiottoController(object):
     middleware_interrupt = None
     persist_data = None
+    streaming_entry = None
+
+    # streamed responses bigger than this (in bytes) are not cached.
+    max_cached_stream_size = 1024 * 1024
 
     def __init__(self, request, manifest, model_mock=False, errors=None):
         self.request = request
@@ -32,7 +38,15 @@ class GiottoController(object):
         self.raw_args = parsed['raw_args']
         self.program = parsed['program']
         self.program.name_on_manifest = parsed['program_name']
+        self.program_path = parsed['path'] + parsed['program_name']
         self.path_args = parsed['args']
+        if self.path_args and self.manifest.is_root_path(self.program_path):
+            if not self.program.model_binding.takes_raw:
+                # the invocation names a program that doesn't exist. Don't
+                # hand the name to the root program as an argument, 404 instead.
+                # raised from get_data_response() like middleware exceptions.
+                msg = "Can't find %s" % parsed['invocation']
+                self.middleware_interrupt_exc = ProgramNotFound(msg)
         if parsed['superformat']:
             self.mimetype = parsed['superformat_mime'] or parsed['superformat']
         else:
@@ -84,69 +98,132 @@ class GiottoController(object):
 
         if self.model_mock and self.program.has_mock_defined():
             model_data = self.program.get_model_mock()
+            response = self.program.execute_view(model_data, self.mimetype, self.errors)
         else:
-            args, kwargs = self.program.get_model_args_kwargs()
-            data = self.get_data_for_model(args, kwargs)
+            data = self.get_data_for_model()
             self.display_data = data # just for displaying in __repr__
 
-            if self.program.cache and not self.errors:
-                key = self.get_cache_key(data)
-                hit = self.cache.get(key)
-                if hit:
-                    return hit
-        
-            model_data = self.program.execute_model(data)
-        
-        response = self.program.execute_view(model_data, self.mimetype, self.errors)
-
-        if self.program.cache and not self.errors and not self.model_mock:
-            self.cache.set(key, response, self.program.cache)
+            if self.program.cache and not self.errors and not self.model_mock:
+                response = self.get_cached_response(data)
+            else:
+                response = self.execute_program(data)
 
         if 'persist' in response:
             self.persist_data = response['persist']
 
         return response
 
-    def get_data_for_model(self, args, kwargs):
+    def execute_program(self, data):
+        """
+        Run the model and then the view. Returns the output of the view.
+        """
+        model_data = self.program.execute_model(data)
+        return self.program.execute_view(model_data, self.mimetype, self.errors)
+
+    def get_cached_response(self, data):
+        """
+        Get the response for this invocation out of the cache, or run the
+        program and cache its response. Responses are stored wrapped in a dict
+        that also records when the response turns stale. Stale responses are
+        still served for `program.cache_stale` seconds while a background
+        thread recalculates them.
+        """
+        key = self.get_cache_key(data)
+        compute = lambda: self.execute_and_cache(key, data)
+        hit = self.cache.get(key)
+        if hit:
+            if hit['stale_after'] < time.time():
+                refresh = lambda: self.execute_and_cache(key, data, drain=True)
+                refresh_in_background(self.cache, key, refresh)
+            return hit['response']
+
+        # only one request at a time recalculates a missing key,
+        # concurrent requests for the same key wait for its result.
+        entry = single_flight(self.cache, key, compute)
+        if entry.get('stream') and entry is not self.streaming_entry:
+            # another request is streaming this response and a stream can
+            # only be sent once, so make our own.
+            return self.execute_program(data)
+        return entry['response']
+
+    def execute_and_cache(self, key, data, drain=False):
+        """
+        Run the program and store its response in the cache. A streamed
+        response is cached once it has been sent to the client in full,
+        or right away if `drain` is set.
+        """
+        response = self.execute_program(data)
+        if is_stream(response.get('body')):
+            if not drain:
+                response['body'] = self.tee_into_cache(key, response, response['body'])
+                self.streaming_entry = {'response': response, 'stream': True}
+                return self.streaming_entry
+            response['body'] = b''.join(encode_chunks(response['body']))
+
+        return self.cache_response(key, response)
+
+    def cache_response(self, key, response):
+        if 'etag' not in response:
+            # calculate the etag now, so it gets stored in the cache with
+            # the response and doesn't need to be calculated on each hit.
+            response['etag'] = make_etag(response.get('body'))
+            response['last_modified'] = int(time.time())
+        response = self.program.execute_cache_middleware(response, self)
+        entry = {
+            'response': response,
+            'stale_after': time.time() + self.program.cache,
+        }
+        self.cache.set(key, entry, self.program.cache + self.program.cache_stale)
+        return entry
+
+    def tee_into_cache(self, key, response, body):
         """
-        In comes args and kwargs expected for the model. Out comes the data from
-        this invocation that will go to the model.
+        Pass along the chunks of `body`, a streamed response, while keeping a copy.
+        When the stream ends, the copy is cached. Nothing is cached if the
+        stream is not read to the end or is bigger than
+        `max_cached_stream_size`.
+        """
+        stream = encode_chunks(body)
+        chunks, size = [], 0
+        try:
+            for chunk in stream:
+                if chunks is not None:
+                    size += len(chunk)
+                    chunks.append(chunk)
+                    if size > self.max_cached_stream_size:
+                        chunks = None
+                yield chunk
+        finally:
+            stream.close()
+
+        if chunks is not None:
+            self.cache_response(key, dict(response, body=b''.join(chunks)))
+
+    def get_data_for_model(self):
+        """
+        Run the program's model binding plan against the data from this
+        invocation. Out comes the data that will go to the model.
         In other words, this function does the "data negotiation" between the
         controller and the model.
         """
+        binding = self.program.model_binding
         kwargs_from_invocation = self.get_raw_data()
         args_from_invocation = deque(self.path_args)
 
-        defaults = kwargs
-        values = args + list(kwargs.keys())
-
         output = {}
 
-        raw = False
-        for i, field in enumerate(values):
+        # when the model takes the RAW_INVOCATION_ARGS primitive, all
+        # positional args are invalid, and unused args are not an error.
+        raw = binding.takes_raw
+        for field, default_defined_in_model, primitive, is_raw in binding.fields:
             ## going through each bit of data that the model needs
             ## `field` here is the name of each needed var.
 
-            # the 'default' value that may be defined in the model.
-            # this variable might be a string or int or might even be a primitive object.
-            # NotImplemented here is used as to preserve if a default value is None.
-            # it is used here as a sort of MetaNone.
-            default_defined_in_model = defaults.get(field, NotImplemented)
-            
             # the value in kwarg arguments such as --values and GET params
             from_data_kwargs = kwargs_from_invocation.get(field, None)
 
-            # The value that will end up being used.
-            value_to_use = None
-
-            if default_defined_in_model == RAW_INVOCATION_ARGS:
-                # flag that the RAW_INVOCATION_ARGS primitive has been invoked
-                # used later to suppress errors for unused program args
-                # when this primitive is invoked, all positional args are invalid. 
-                raw = True
-
-            if type(default_defined_in_model) == GiottoPrimitive:
-                value_to_use = self.get_primitive(default_defined_in_model.name)
+            if primitive:
+                value_to_use = self.get_primitive(primitive.name)
             elif from_data_kwargs:
                 value_to_use = from_data_kwargs
             elif not raw and args_from_invocation:
@@ -155,12 +232,12 @@ class GiottoController(object):
                 value_to_use = default_defined_in_model
             else:
                 raise InvalidInvocation("Data Missing For Program. Missing: %s" % field)
-            
+
             output[field] = value_to_use
 
         if args_from_invocation and not raw:
             msg = "Too many arguments. Program `%s` takes %s arguments, %s given" % (
-                self.program.name, len(args) + len(kwargs), len(args_from_invocation)
+                self.program.name, len(binding.fields), len(args_from_invocation)
             )
             raise InvalidInvocation(msg)
 
@@ -188,11 +265,19 @@ class GiottoController(object):
         return None
 
     def get_cache_key(self, data):
-        try:
-            controller_args = json.dumps(data, separators=(',', ':'), sort_keys=True)
-        except TypeError:
-            # controller contains info that can't be json serialized:
-            controller_args = str(data)
+        """
+        The key is made up of the program's path on the manifest, and a hash
+        of the mimetype, the model arguments and the current generation of the
+        program's cache tags. If the program has `cache_vary` defined, only
+        those model arguments are used.
+        """
+        generations = None
+        tags = self.program.get_cache_tags(data)
+        if tags:
+            generations = get_tag_generations(self.cache, tags)
+
+        if self.program.cache_vary is not None:
+            data = dict((k, v) for k, v in data.items() if k in self.program.cache_vary)
 
-        program = self.program.name
-        return "%s(%s)(%s)" % (controller_args, program, self.mimetype)
+        digest = make_digest(self.mimetype, data, generations)
+        return "%s(%s)" % (self.program_path, digest)
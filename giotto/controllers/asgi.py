@@ -0,0 +1,295 @@
+"""
+ASGI version of the http controller. Models, views (render functions) and
+middleware can be `async def` functions, which are awaited on the event loop.
+Plain functions still work: sync models and middleware are run in a thread
+pool so they don't block the event loop. Requires python 3.5+.
+"""
+import asyncio
+import functools
+import sys
+from io import BytesIO
+
+from webob import Request, Response
+
+from giotto.exceptions import InvalidInput, GiottoException
+from giotto.control import GiottoControl
+from giotto.controllers.http import HTTPController, make_duplicate_request, refresh_etag
+
+# the thread pool sync models and middleware run in,
+# None means the event loop's default executor.
+executor = None
+
+async def call(func, *args, **kwargs):
+    """
+    Await `func` if it is a coroutine function, otherwise run it in the thread pool.
+    """
+    if asyncio.iscoroutinefunction(func):
+        return await func(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+def get_controller_name(controller):
+    return controller.get_controller_name().split('-')[0] # 'http-get' -> 'http'
+
+class AsyncHTTPController(HTTPController):
+    """
+    Same as HTTPController, except the middleware, model and view are run
+    with `await controller.get_response()`.
+    """
+    data_response = None
+    data_exception = None
+
+    async def get_response(self):
+        self.loop = asyncio.get_event_loop()
+        last_good_request = self.request
+        middleware_result = None
+        try:
+            last_good_request, middleware_result = await self.execute_input_middleware_stream()
+        except GiottoException as exc:
+            self.middleware_interrupt_exc = exc
+            self.request = last_good_request
+        else:
+            self.request = middleware_result
+
+        if GiottoControl in type(middleware_result).mro():
+            self.middleware_control = middleware_result
+            self.request = last_good_request
+
+        try:
+            self.data_response = await self.get_data_response_async()
+        except InvalidInput as exc:
+            ## retry the request as a GET request for the same program,
+            ## and set the code to 400.
+            request = make_duplicate_request(self.request)
+            request.method = 'GET'
+            c = AsyncHTTPController(request, self.manifest, self.model_mock, errors=exc)
+            response = await c.get_response()
+            response.status_int = 400
+        except GiottoException as exc:
+            self.data_exception = exc
+            response = self.get_concrete_response()
+        else:
+            response = self.get_concrete_response()
+
+        if self.persist_data:
+            response = self.persist(self.persist_data, response)
+
+        response = await self.execute_output_middleware_stream(response)
+        return refresh_etag(response)
+
+    def get_data_response(self):
+        """
+        Called by `HTTPController.get_concrete_response`, by the time it is
+        called the program has already been run.
+        """
+        if self.data_exception:
+            raise self.data_exception
+        return self.data_response
+
+    async def get_data_response_async(self):
+        if self.middleware_interrupt_exc:
+            raise self.middleware_interrupt_exc
+
+        if self.middleware_control:
+            return {'body': self.middleware_control}
+
+        if self.model_mock and self.program.has_mock_defined():
+            model_data = self.program.get_model_mock()
+            response = await self.execute_view(model_data)
+        else:
+            data = self.get_data_for_model()
+            self.display_data = data # just for displaying in __repr__
+
+            if self.program.cache and not self.errors and not self.model_mock:
+                # the cache layer is synchronous, see `execute_program`
+                response = await call(self.get_cached_response, data)
+            else:
+                response = await self.execute_program_async(data)
+
+        if 'persist' in response:
+            self.persist_data = response['persist']
+
+        return response
+
+    def execute_program(self, data):
+        """
+        The cache layer calls this from a thread in the thread pool when it
+        needs to (re)calculate a response. Run the program on the event loop
+        and wait for it.
+        """
+        future = asyncio.run_coroutine_threadsafe(self.execute_program_async(data), self.loop)
+        return future.result()
+
+    async def execute_program_async(self, data):
+        model = self.program.get_model()
+        model_data = None if model is None else await call(model, **data)
+        return await self.execute_view(model_data)
+
+    async def execute_view(self, model_data):
+        view = self.program.view
+        if not view:
+            return {'body': '', 'mimetype': ''}
+
+        renderer = view.get_renderer(self.mimetype)
+        if not renderer.is_control and asyncio.iscoroutinefunction(renderer.func):
+            data = await view.call_renderer(renderer, model_data, self.errors)
+            return view.finish_render(renderer, model_data, data)
+        return view.render(model_data, self.mimetype, self.errors)
+
+    def get_concrete_response(self):
+        result = self.data_response
+        if result and hasattr(result.get('body'), '__aiter__'):
+            # an async generator, sent to the client by the asgi app
+            response = Response(status=200, app_iter=result['body'], content_type=result['mimetype'] or None)
+            response.lazy_data = None
+            self.set_cache_control(response, result)
+            return response
+        return super(AsyncHTTPController, self).get_concrete_response()
+
+    async def execute_input_middleware_stream(self):
+        start_request = request = self.request
+        middlewares = list(self.program.pre_input_middleware) + list(self.program.input_middleware)
+        for m in middlewares:
+            to_execute = getattr(m(self), get_controller_name(self), None)
+            if to_execute:
+                result = await call(to_execute, request)
+                if GiottoControl in type(result).mro():
+                    # a middleware class returned a control object (redirection, et al.)
+                    # ignore all other middleware classes
+                    return request, result
+                request = result
+        return start_request, request
+
+    async def execute_output_middleware_stream(self, response):
+        for m in self.program.output_middleware:
+            to_execute = getattr(m(self), get_controller_name(self), None)
+            if to_execute:
+                response = await call(to_execute, self.request, response)
+        return response
+
+def make_environ(scope, body):
+    """
+    Make a WSGI environ out of an ASGI connection scope, so the request can
+    be handled with webob.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            # repeated headers are joined the way a proxy would, except cookies
+            separator = '; ' if name == 'HTTP_COOKIE' else ','
+            value = environ[name] + separator + value
+        environ[name] = value
+    return environ
+
+async def read_body(receive):
+    """
+    Read the whole request body. Returns None if the client disconnects
+    before sending all of it.
+    """
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(body)
+
+async def send_response(response, environ, send):
+    """
+    Send a webob response to the client. The response is called as a WSGI
+    app, so conditional (304) and Range requests are handled the same way
+    as by the WSGI app. Sync iterators (files, generators) are read in the
+    thread pool, async iterators are read on the event loop.
+    """
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    app_iter = response(environ, start_response)
+    await send({
+        'type': 'http.response.start',
+        'status': started['status'],
+        'headers': [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in started['headers']
+        ],
+    })
+
+    charset = response.charset or 'utf-8'
+    async def send_chunk(chunk):
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode(charset)
+        if chunk:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+    try:
+        if hasattr(app_iter, '__aiter__'):
+            async for chunk in app_iter:
+                await send_chunk(chunk)
+        elif type(app_iter) is list:
+            for chunk in app_iter:
+                await send_chunk(chunk)
+        else:
+            iterator, done = iter(app_iter), object()
+            while True:
+                chunk = await call(next, iterator, done)
+                if chunk is done:
+                    break
+                await send_chunk(chunk)
+    finally:
+        if hasattr(app_iter, 'close'):
+            await call(app_iter.close)
+
+    await send({'type': 'http.response.body', 'body': b''})
+
+def make_asgi_app(manifest, model_mock=False):
+    """
+    ASGI version of `giotto.controllers.http.make_app`.
+    """
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                await send({'type': message['type'] + '.complete'})
+                if message['type'] == 'lifespan.shutdown':
+                    return
+
+        if scope['type'] != 'http':
+            return
+
+        body = await read_body(receive)
+        if body is None:
+            # the client went away, don't run the program on half a request.
+            return
+
+        environ = make_environ(scope, body)
+        request = Request(environ)
+        controller = AsyncHTTPController(request, manifest, model_mock=model_mock)
+        response = await controller.get_response()
+        await send_response(response, environ, send)
+
+    return application
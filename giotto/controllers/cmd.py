@@ -1,11 +1,31 @@
+import io
 import os
-
-from giotto.utils import parse_kwargs
+import sys
+import signal
+import socket
+import struct
+import threading
+import traceback
+
+from giotto.utils import parse_kwargs, is_stream, decode_chunks, decode_body
 from giotto.controllers import GiottoController
 from giotto.control import Redirection
 
+# goes at the very top of the concrete controller, so invocations are handed
+# off to the daemon (if it is running) before the slow imports happen.
+cmd_client_snippet = """import os, sys
+from giotto.cmd_client import run_through_daemon
+socket_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cmd_daemon.sock')
+run_through_daemon(sys.argv, socket_path)
+"""
+
 cmd_execution_snippet = """
 args = sys.argv
+if '--daemon' in args:
+    from giotto.controllers.cmd import serve_daemon
+    serve_daemon(manifest, socket_path)
+    sys.exit()
+
 mock = '--model-mock' in args
 if mock:
     # remove the mock argument so the controller doesn't get confused
@@ -89,9 +109,14 @@ class CMDController(GiottoController):
         if hasattr(stdout, 'write'):
             # returned is a file, print out the contents through stdout
             print(stdout.write())
+        elif is_stream(result['body']):
+            # write each chunk out as soon as the view makes it
+            for chunk in decode_chunks(result['body']):
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
         else:
             for line in stdout:
-                print(line)
+                print(decode_body(line))
 
         for line in response['stderr']:
             sys.stderr.write(line)
@@ -106,3 +131,110 @@ class CMDController(GiottoController):
             return self.get_raw_data()
         elif name == 'LOGGED_IN_USER':
             return getattr(self.request, 'user', None)
+
+def serve_daemon(manifest, socket_path, model_mock=False):
+    """
+    Keep this (initialized) process running, and listen on the unix socket
+    at `socket_path` for invocations from `giotto.cmd_client`. Each
+    invocation runs in a forked copy of this process, with the client's
+    stdin, stdout and stderr, environment and working directory, so the
+    output goes straight to the client's terminal. Restart the daemon
+    after changing the code of the project.
+    """
+    from giotto.cmd_client import recv_invocation
+    from giotto.server import prepare_for_fork
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            os.unlink(socket_path) # left over from a daemon that died
+        else:
+            raise SystemExit("A daemon is already listening on %s" % socket_path)
+        finally:
+            probe.close()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    listener.listen(64)
+    prepare_for_fork()
+    # children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print("Giotto cmd daemon listening on %s" % socket_path)
+
+    try:
+        while True:
+            connection, address = listener.accept()
+            try:
+                invocation, fds = recv_invocation(connection)
+            except Exception:
+                traceback.print_exc()
+                connection.close()
+                continue
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if not os.fork():
+                listener.close()
+                run_daemon_invocation(manifest, connection, invocation, fds, model_mock)
+
+            connection.close()
+            for fd in fds:
+                os.close(fd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.unlink(socket_path)
+
+def run_daemon_invocation(manifest, connection, invocation, fds, model_mock):
+    """
+    Runs in the forked child, never returns.
+    """
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    # new file objects, buffered the way they would be in a new process
+    sys.stdin = io.open(0, 'r', closefd=False)
+    sys.stdout = io.open(1, 'w', buffering=1 if os.isatty(1) else -1, closefd=False)
+    sys.stderr = io.open(2, 'w', buffering=1, closefd=False)
+    os.chdir(invocation['cwd'])
+    os.environ.clear()
+    os.environ.update(invocation['env'])
+
+    def watch_client():
+        # the client closes the connection when it gets interrupted (ctrl-c)
+        if not connection.recv(1):
+            os.kill(os.getpid(), signal.SIGINT)
+    watcher = threading.Thread(target=watch_client)
+    watcher.daemon = True
+    watcher.start()
+
+    argv = list(invocation['argv'])
+    mock = model_mock or '--model-mock' in argv
+    if '--model-mock' in argv:
+        argv.remove('--model-mock')
+    sys.argv = argv
+
+    status = 0
+    try:
+        controller = CMDController(request=CMDRequest(argv), manifest=manifest, model_mock=mock)
+        controller.get_response()
+    except SystemExit as exc:
+        status = exc.code if isinstance(exc.code, int) else (1 if exc.code else 0)
+    except KeyboardInterrupt:
+        status = 130
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        connection.sendall(struct.pack('!i', status))
+    finally:
+        os._exit(status)
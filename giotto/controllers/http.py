@@ -1,5 +1,8 @@
+import os
+import re
 import traceback
 import base64
+from io import UnsupportedOperation
 
 try:
     from urllib.parse import urlencode, unquote
@@ -14,7 +17,8 @@ except ImportError:
 from giotto.exceptions import NoViewMethod, InvalidInput, NotAuthorized, DataNotFound, ProgramNotFound
 from giotto.controllers import GiottoController
 from giotto.control import Redirection
-from giotto.utils import render_error_page
+from giotto.utils import (render_error_page, make_etag, is_stream, encode_chunks,
+    choose_encoding, compress, compress_stream, is_compressible)
 from webob import Request, Response
 from webob.exc import (
     HTTPUnsupportedMediaType, HTTPMethodNotAllowed, HTTPFound,
@@ -36,15 +40,35 @@ if '--run' in sys.argv:
 
 if '--run-ssl' in sys.argv:
     serve('127.0.0.1', 443, application, ssl='adhoc', use_debugger=True, use_reloader=True)
+
+if '--serve' in sys.argv:
+    serve(
+        get_config('http_host', '127.0.0.1'), get_config('http_port', 5000), application,
+        workers=get_config('http_workers', 4), threads=get_config('http_threads', 8),
+        max_requests=get_config('http_max_requests', 0), max_memory=get_config('http_max_memory', 0),
+        timeout=get_config('http_timeout', 30),
+    )
 """
 
 
-def serve(ip, port, application, ssl=None, processes=1, **kwargs):
+def serve(ip, port, application, ssl=None, processes=1, workers=0, threads=8,
+          max_requests=0, max_memory=0, timeout=30, **kwargs):
     """
     Serve a wsgi app (any wsgi app) through with either werkzeug's runserver
     or the one that comes with python. Setting `processes` to anything other than 1
     will prevent the debigger from working.
+    Setting `workers` serves the app with the production pre-forking server
+    instead (see giotto.server.PreforkServer), `ssl` is not supported there.
     """
+    if workers:
+        if ssl:
+            raise ValueError("The production server does not support ssl, put a proxy in front of it.")
+        from giotto.server import PreforkServer
+        PreforkServer(
+            ip, port, application, workers=workers, threads=threads,
+            max_requests=max_requests, max_memory=max_memory, timeout=timeout
+        ).run()
+        return
 
     try:
         # use werkzeug if its there
@@ -105,6 +129,10 @@ class HTTPController(GiottoController):
     def get_invocation(self):
         return self.request.path
 
+    def get_response(self):
+        response = super(HTTPController, self).get_response()
+        return refresh_etag(response)
+
     def get_controller_name(self):
         return 'http-%s' % self.request.method.lower()
 
@@ -156,18 +184,114 @@ class HTTPController(GiottoController):
                 body = ''
 
             if hasattr(body, 'read'):
+                response = self.make_file_response(body, result)
+                if response:
+                    return response
                 body = body.read()
 
+            if is_stream(body):
+                return self.make_stream_response(body, result)
+
             response = Response(
                 status=200,
                 body=body,
                 content_type=result['mimetype'],
+                conditional_response=True,
             )
 
             response.lazy_data = lazy
+            response.precompressed = result.get('compressed')
+            if not lazy:
+                self.set_caching_headers(response, result)
+            set_source_body(response)
+
+        return response
+
+    def make_file_response(self, file, result):
+        """
+        Make a response that streams `file` instead of reading it into memory.
+        The file is sent through the server's wsgi.file_wrapper (which can use
+        sendfile) when there is one. The etag and Last-Modified headers come
+        from the file's size and modification time. Since the response is
+        conditional, webob handles 304s and Range requests.
+        Returns None if `file` is not a real file on disk.
+        """
+        try:
+            stat = os.fstat(file.fileno())
+        except (AttributeError, IOError, OSError, UnsupportedOperation):
+            return None
+
+        encodings = result.get('encodings')
+        encoding = encodings and choose_encoding(
+            self.request.headers.get('Accept-Encoding'), [e for e in ('br', 'gzip') if e in encodings]
+        )
+        if encoding:
+            # serve the precompressed version of the file instead.
+            file.close()
+            file = open(encodings[encoding], 'rb')
+            stat = os.fstat(file.fileno())
+
+        environ = getattr(self.request, 'environ', {})
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper and not self.request.headers.get('Range'):
+            app_iter = file_wrapper(file, FileIterator.block_size)
+        else:
+            app_iter = FileIterator(file)
+
+        response = Response(
+            status=200,
+            app_iter=app_iter,
+            content_type=result['mimetype'] or None,
+            conditional_response=True,
+        )
+        response.content_length = stat.st_size
+        response.last_modified = int(stat.st_mtime)
+        response.etag = "%x-%x" % (int(stat.st_mtime), stat.st_size)
+        response.accept_ranges = 'bytes'
+        response.lazy_data = None
+        if encodings:
+            response.vary = ['Accept-Encoding']
+        if encoding:
+            response.content_encoding = encoding
+        self.set_cache_control(response, result)
+        return response
 
+    def make_stream_response(self, body, result):
+        """
+        Make a response that sends each chunk of a generator or iterator
+        body to the client as soon as it is made. The length and the etag of
+        the body are not known up front, so there is no Content-Length and
+        no conditional response.
+        """
+        response = Response(
+            status=200,
+            app_iter=encode_chunks(body),
+            content_type=result['mimetype'] or None,
+        )
+        response.lazy_data = None
+        self.set_cache_control(response, result)
         return response
 
+    def set_cache_control(self, response, result):
+        cache_control = result.get('cache_control') or self.program.cache_control
+        if type(cache_control) is int:
+            response.cache_control.max_age = cache_control
+        elif cache_control:
+            response.headers['Cache-Control'] = cache_control
+
+    def set_caching_headers(self, response, result):
+        """
+        Add the ETag, Last-Modified and Cache-Control headers. Since the
+        response is conditional, webob answers with a 304 when the request's
+        If-None-Match or If-Modified-Since headers match.
+        """
+        etag = result.get('etag') or make_etag(response.body)
+        if etag:
+            response.etag = etag
+        if result.get('last_modified'):
+            response.last_modified = result['last_modified']
+        self.set_cache_control(response, result)
+
     def persist(self, persist, response):
         for key, value in persist.items():
             response.set_cookie(key, value)
@@ -188,6 +312,71 @@ class HTTPController(GiottoController):
         raise Exception("Primitive not supported")
 
 
+class FileIterator(object):
+    """
+    WSGI app iterator that reads a file one block at a time, from byte `start`
+    up to byte `stop`. Webob calls `app_iter_range` to answer Range requests.
+    """
+    block_size = 64 * 1024
+
+    def __init__(self, file, start=None, stop=None):
+        self.file = file
+        self.start = start
+        self.stop = stop
+
+    def __iter__(self):
+        if self.start:
+            self.file.seek(self.start)
+        remaining = None
+        if self.stop is not None:
+            remaining = self.stop - (self.start or 0)
+
+        while remaining is None or remaining > 0:
+            size = self.block_size
+            if remaining is not None:
+                size = min(size, remaining)
+                remaining -= size
+            chunk = self.file.read(size)
+            if not chunk:
+                break
+            yield chunk
+
+    def app_iter_range(self, start, stop):
+        return FileIterator(self.file, start, stop)
+
+    def close(self):
+        self.file.close()
+
+
+def set_source_body(response):
+    """
+    Remember the body and etag of `response` as they are now, so
+    `refresh_etag` can tell whether output middleware changed the body.
+    """
+    response.source_body = response.body
+    response.source_etag = response.etag
+
+def refresh_etag(response):
+    """
+    The ETag and Last-Modified headers are set (or come from the cache)
+    before the output middleware runs. If a middleware changed the body,
+    those headers describe a different body, so calculate a new etag and
+    drop Last-Modified. An etag set by the middleware itself is kept.
+    The bodies compressed before caching are dropped too.
+    """
+    source = getattr(response, 'source_body', None)
+    if source is None or type(response.app_iter) is not list:
+        return response
+    body = response.body
+    if body is source or body == source:
+        return response
+    response.precompressed = None
+    if response.etag == response.source_etag:
+        response.etag = make_etag(body)
+        response.last_modified = None
+    set_source_body(response)
+    return response
+
 def make_duplicate_request(request):
     """
     Since werkzeug request objects are immutable, this is needed to create an
@@ -226,6 +415,83 @@ def make_app(manifest, model_mock=False, cache=None):
     return application
 
 
+def compress_response(request, response, min_size=1024, level=5):
+    """
+    Compress `response` with gzip or brotli, whichever the client prefers
+    according to its Accept-Encoding header. Only responses with a
+    compressible mimetype and a body of at least `min_size` bytes are
+    compressed. Streamed bodies are compressed chunk by chunk. Files are left
+    alone, so they can still be sent with sendfile and answer Range requests
+    (use `build_static` to compress static files ahead of time).
+    Bodies that were compressed when they were cached (in
+    `response.precompressed`) are not compressed again, unless an earlier
+    output middleware changed the body.
+    """
+    if (response.status_int != 200 or response.content_encoding
+            or not is_compressible(response.content_type)
+            or 'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+
+    in_memory = type(response.app_iter) is list
+    if not in_memory and (response.content_length is not None or hasattr(response.app_iter, '__aiter__')):
+        # a file, or an async stream from the asgi controller
+        return response
+
+    vary_on_encoding(response)
+
+    if in_memory and response.content_length < min_size:
+        return response
+
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if not encoding:
+        return response
+
+    if in_memory:
+        refresh_etag(response)
+        precompressed = getattr(response, 'precompressed', None) or {}
+        etag = response.etag
+        response.body = precompressed.get(encoding) or compress(response.body, encoding, level)
+        if etag:
+            # each encoding of the body is a different representation
+            response.etag = "%s-%s" % (etag, encoding)
+        set_source_body(response)
+    else:
+        response.app_iter = compress_stream(response.app_iter, encoding, level)
+
+    response.content_encoding = encoding
+    return response
+
+def vary_on_encoding(response):
+    if 'Accept-Encoding' not in (response.vary or ()):
+        response.vary = tuple(response.vary or ()) + ('Accept-Encoding',)
+
+def compress_middleware(app, min_size=1024, level=5):
+    """
+    WSGI middleware that compresses the responses of `app`, see `compress_response`.
+    """
+    def application(environ, start_response):
+        request = Request(environ)
+        if_none_match = request.headers.get('If-None-Match')
+        encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+        if if_none_match and encoding:
+            # `compress_response` adds the encoding to the etag. Strip it, so the
+            # wrapped app can still answer with a 304, but only when the client
+            # would get that same encoding now.
+            suffix = re.compile(r'-%s(?=")' % re.escape(encoding))
+            request.headers['If-None-Match'] = suffix.sub('', if_none_match)
+
+        response = request.get_response(app)
+        if response.status_int == 304:
+            etag = response.etag
+            if etag and encoding and '"%s-%s"' % (etag, encoding) in if_none_match:
+                response.etag = "%s-%s" % (etag, encoding)
+            vary_on_encoding(response)
+            return response(environ, start_response)
+
+        return compress_response(request, response, min_size, level)(environ, start_response)
+
+    return application
+
 def fancy_error_template_middleware(app):
     """
     WGSI middleware for catching errors and rendering the error page.
@@ -10,8 +10,9 @@ except ImportError:
   raise ImportError("Requires irclib; pip install irc")
 
 from giotto.controllers import GiottoController
+from giotto.controllers.irc_outbound import OutboundScheduler
 from giotto.exceptions import ProgramNotFound
-from giotto.utils import parse_kwargs
+from giotto.utils import parse_kwargs, decode_body, TokenBucket, KeyedWorkerPool
 
 irc_execution_snippet = """
 parser = argparse.ArgumentParser(description='Giotto IRC Controller')
@@ -27,6 +28,12 @@ config = {
     'owner': '',
     'channels': '', # comma seperated
     'magic_token': '!giotto ',
+    'workers': 4, # how many programs can run at once
+    'max_queue': 50, # invocations waiting to run before the bot replies that it's busy
+    'user_rate': 0.5, # invocations per second each user can make,
+    'user_burst': 5, # after a burst of this many
+    'send_rate': 1.0, # messages per second the bot sends,
+    'send_burst': 5, # after a burst of this many
 }
 from giotto.controllers.irc_ import listen
 listen(manifest, config, model_mock=args.model_mock)"""
@@ -53,7 +60,7 @@ class IRCController(GiottoController):
 
         # convert to a format appropriate to the IRC Response api.
         return dict(
-            response=result['body'],
+            response=decode_body(result['body']),
             say_to=self.request.sent_to,
         )
 
@@ -141,6 +148,13 @@ class IrcBot(irc.bot.SingleServerIRCBot):
             self.channel = channels
             print("Joining Channels: %s" % channels)
         self.config = config
+        self.user_buckets = {}
+        self.pool = KeyedWorkerPool(config.get('workers', 4), config.get('max_queue', 50))
+        self.outbound = OutboundScheduler(
+            lambda target, text: self.connection.privmsg(target, text),
+            rate=config.get('send_rate', 1.0), burst=config.get('send_burst', 5),
+        )
+        self.ircobj.execute_every(0.1, self.outbound.tick)
   
     def on_nicknameinuse(self, connection, event):
         connection.nick(connection.get_nickname + "_")
@@ -157,27 +171,60 @@ class IrcBot(irc.bot.SingleServerIRCBot):
         self.process_message(connection, event)
  
     def process_message(self, connection, event):
+        """
+        Runs on the reactor thread. Hand the invocation off to the worker
+        pool, so slow programs don't hold up the bot. Invocations from the
+        same channel (or user, for private messages) run in the order they
+        came in.
+        """
         request = IRCRequest(
             event,
             self.config['magic_token'],
             connection.get_nickname()
         )
-        
+        reply_to = request.username if request.private_message else request.sent_to
+
+        if not self.allow(request.username):
+            return # flooding, ignore
+
+        if not self.pool.submit(reply_to, self.run_program, request, reply_to):
+            self.reply(reply_to, "%s: busy, try again later" % request.username)
+
+    def run_program(self, request, reply_to):
+        """
+        Runs in a worker thread.
+        """
         try:
             controller = IRCController(request, self.config['manifest'], self.config['model_mock'])
             result = controller.get_response()
         except Exception as exc:
             cls = exc.__class__.__name__
-            connection.privmsg(request.sent_to, "\x0304%s - %s: %s" % (request.program, cls, exc))
+            self.reply(reply_to, "\x0304%s - %s: %s" % (request.program, cls, exc))
             traceback.print_exc(file=sys.stdout)
         else:
-            msg = "%s: %s" % (request.username, result['response'])
-            if request.private_message:
-                for m in msg.split('\n'):
-                    connection.privmsg(request.username, m)
-            else:
-                for m in msg.split('\n'):
-                    connection.privmsg(request.sent_to, m)
+            self.reply(reply_to, "%s: %s" % (request.username, result['response']))
+
+    def allow(self, username):
+        """
+        Per user rate limit, returns False if the user is making too
+        many invocations.
+        """
+        bucket = self.user_buckets.get(username)
+        if not bucket:
+            if len(self.user_buckets) > 10000:
+                self.user_buckets.clear()
+            bucket = self.user_buckets[username] = TokenBucket(
+                self.config.get('user_rate', 0.5), self.config.get('user_burst', 5)
+            )
+        return bucket.take()
+
+    def reply(self, target, message):
+        """
+        Queue up a message to be sent. Can be called from any thread, the
+        message is sent from the reactor thread, paced so the bot doesn't
+        flood the server.
+        """
+        self.outbound.add(target, message)
 
 def listen(manifest, config, model_mock=False):
     """
@@ -0,0 +1,133 @@
+import threading
+from collections import OrderedDict, deque
+
+from giotto.utils import TokenBucket
+
+def split_line(line, limit):
+    """
+    Split `line` into pieces of at most `limit` bytes (when utf-8 encoded),
+    without cutting a character in half.
+    >>> split_line(u'abcdef', 4)
+    ['abcd', 'ef']
+    """
+    if len(line.encode('utf-8')) <= limit:
+        return [line]
+    pieces, current, size = [], [], 0
+    for char in line:
+        length = len(char.encode('utf-8'))
+        if size + length > limit:
+            pieces.append(''.join(current))
+            current, size = [], 0
+        current.append(char)
+        size += length
+    pieces.append(''.join(current))
+    return pieces
+
+class OutboundScheduler(object):
+    """
+    Paces outgoing IRC messages so the bot doesn't get kicked for flooding.
+    Messages to each target (channel or user) are limited by a token bucket,
+    and so are all messages together, since servers throttle per connection.
+    Short lines going to the same target are merged into one message, up to
+    the 512 byte protocol limit. Short replies go out before the lines of
+    long ones, so a big dump doesn't hold up everyone else.
+
+    `add` can be called from any thread, `tick` must be called periodically
+    from the thread that owns the connection, it calls `send(target, text)`
+    for each message that may go out now.
+    """
+    line_limit = 512
+
+    # room for the ":nick!user@host " prefix the server adds when it relays
+    # the message to other clients, which also has to fit in `line_limit`.
+    prefix_reserve = 100
+
+    # replies with at most this many lines are sent before longer ones.
+    short_reply = 2
+
+    # only lines shorter than this get merged.
+    merge_length = 100
+    separator = ' | '
+
+    def __init__(self, send, rate=1.0, burst=5, target_rate=0.5, target_burst=4):
+        self.send = send
+        self.bucket = TokenBucket(rate, burst)
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self.target_buckets = {}
+        # target -> (short reply lines, long reply lines), in round robin order
+        self.queues = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_limit(self, target):
+        """
+        The most bytes of text a message to `target` can hold.
+        """
+        overhead = len(("PRIVMSG %s :\r\n" % target).encode('utf-8'))
+        return self.line_limit - self.prefix_reserve - overhead
+
+    def add(self, target, message):
+        limit = self.get_limit(target)
+        lines = []
+        for line in message.split('\n'):
+            if line.strip():
+                lines.extend(split_line(line.rstrip('\r'), limit))
+
+        if not lines:
+            return
+
+        with self.lock:
+            if target not in self.queues:
+                self.queues[target] = (deque(), deque())
+            self.queues[target][0 if len(lines) <= self.short_reply else 1].extend(lines)
+
+    def pending(self):
+        with self.lock:
+            return sum(len(short) + len(long) for short, long in self.queues.values())
+
+    def tick(self):
+        while self.bucket.wait_time() == 0:
+            message = self.next_message()
+            if not message:
+                return
+            self.bucket.take()
+            self.send(*message)
+
+    def next_message(self):
+        """
+        Pick the next message to send, returns a (target, text) tuple, or
+        None if nothing can be sent right now.
+        """
+        with self.lock:
+            for priority in (0, 1):
+                for target, queues in self.queues.items():
+                    lines = queues[priority]
+                    if not lines or not self.get_bucket(target).take():
+                        continue
+
+                    text = self.merge(lines, self.get_limit(target))
+                    # round robin: this target goes to the back of the line
+                    del self.queues[target]
+                    if queues[0] or queues[1]:
+                        self.queues[target] = queues
+                    return target, text
+
+    def merge(self, lines, limit):
+        text = lines.popleft()
+        if len(text) >= self.merge_length:
+            return text
+        while lines and len(lines[0]) < self.merge_length:
+            merged = text + self.separator + lines[0]
+            if len(merged.encode('utf-8')) > limit:
+                break
+            text = merged
+            lines.popleft()
+        return text
+
+    def get_bucket(self, target):
+        bucket = self.target_buckets.get(target)
+        if not bucket:
+            if len(self.target_buckets) > 10000:
+                self.target_buckets.clear()
+            bucket = self.target_buckets[target] = TokenBucket(self.target_rate, self.target_burst)
+        return bucket
@@ -1,6 +1,25 @@
 from collections import defaultdict
-import datetime
+import base64
+import heapq
+import json
+import logging
+import os
 import pickle
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict # python2.6
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic # python2
 
 try:
     import pylibmc
@@ -12,6 +31,114 @@ try:
 except ImportError:
     redis = None
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+class Codec(object):
+    """
+    Baseclass for serializing values before they are sent to a keyvalue
+    backend. Encoded values larger than `threshold` bytes get compressed
+    with `compression` ('zlib' or 'lz4'). The first byte of each encoded
+    value records how it was compressed.
+    """
+    def __init__(self, compression=None, threshold=1024):
+        if compression == 'lz4' and not lz4:
+            msg = 'lz4 not installed! install with: pip install lz4'
+            raise ImportError(msg)
+        if compression not in (None, 'zlib', 'lz4'):
+            raise ValueError("Unknown compression: %s" % compression)
+        self.compression = compression
+        self.threshold = threshold
+
+    def serialize(self, obj):
+        raise NotImplementedError
+
+    def deserialize(self, data):
+        raise NotImplementedError
+
+    def dumps(self, obj):
+        data = self.serialize(obj)
+        if self.compression and len(data) > self.threshold:
+            if self.compression == 'zlib':
+                return b'z' + zlib.compress(data)
+            return b'4' + lz4.compress(data)
+        return b'-' + data
+
+    def loads(self, data):
+        flag, data = data[:1], data[1:]
+        if flag == b'z':
+            data = zlib.decompress(data)
+        elif flag == b'4':
+            data = lz4.decompress(data)
+        elif flag != b'-':
+            # not written by a codec, or by a different version of giotto
+            raise ValueError("Unknown codec flag: %r" % flag)
+        return self.deserialize(data)
+
+class PickleCodec(Codec):
+    protocol = min(5, pickle.HIGHEST_PROTOCOL)
+
+    def serialize(self, obj):
+        return pickle.dumps(obj, self.protocol)
+
+    def deserialize(self, data):
+        return pickle.loads(data)
+
+class MsgpackCodec(Codec):
+    def __init__(self, *args, **kwargs):
+        if not msgpack:
+            msg = 'msgpack not installed! install with: pip install msgpack'
+            raise ImportError(msg)
+        super(MsgpackCodec, self).__init__(*args, **kwargs)
+
+    def serialize(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def deserialize(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+class JSONCodec(Codec):
+    """
+    Bytes (such as cached response bodies) are stored as base64 in an
+    object with a single `__bytes__` key.
+    """
+    def serialize(self, obj):
+        return json.dumps(obj, separators=(',', ':'), default=self.encode_bytes).encode('utf-8')
+
+    def deserialize(self, data):
+        return json.loads(data.decode('utf-8'), object_hook=self.decode_bytes)
+
+    def encode_bytes(self, obj):
+        if isinstance(obj, bytes):
+            return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+        raise TypeError("%r is not JSON serializable" % obj)
+
+    def decode_bytes(self, obj):
+        if len(obj) == 1 and '__bytes__' in obj:
+            return base64.b64decode(obj['__bytes__'])
+        return obj
+
+def get_codec(codec):
+    """
+    Codecs can be given to keyvalue backends either as a Codec object, or as
+    a string such as 'pickle', 'json' or 'msgpack'. Add '+zlib' or '+lz4' to
+    the string to compress large values, eg: 'msgpack+zlib'.
+    """
+    if not hasattr(codec, 'lower'):
+        return codec
+    name, _, compression = codec.partition('+')
+    classes = {'pickle': PickleCodec, 'json': JSONCodec, 'msgpack': MsgpackCodec}
+    if name not in classes:
+        raise ValueError("Unknown codec: %s" % name)
+    return classes[name](compression=compression or None)
+
 class GiottoKeyValue(object):
     """
     Baseclass for all KeyValue object. This exists to demonstrate the API for
@@ -20,48 +147,308 @@ class GiottoKeyValue(object):
     def __init__(*a, **k):
         return
     
-    def set(self, key, obj):
+    def set(self, key, obj, expire):
         raise NotImplementedError
 
-    def get(self, key, obj):
+    def get(self, key):
+        raise NotImplementedError
+
+    def delete(self, key):
         raise NotImplementedError
 
+    def get_many(self, keys):
+        """
+        Returns a dictionary of all the keys that were found. Backends that can
+        fetch many keys in one round trip should override this.
+        """
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set_many(self, mapping, expire):
+        for key, obj in mapping.items():
+            self.set(key, obj, expire)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def acquire_lock(self, key, expire):
+        """
+        Try to take the lock named `key` across all processes using this
+        backend. The lock gets released automatically after `expire` seconds.
+        Returns True if the lock was taken. Backends that are not shared
+        between processes don't need a lock, so this always succeeds.
+        """
+        return True
+
+    def release_lock(self, key):
+        return None
+
+    def encode(self, obj):
+        """
+        Serialize `obj` with this backend's codec. A value the codec can't
+        serialize is not stored, the same as when the cache server is down:
+        this logs a warning and returns None.
+        """
+        try:
+            return self.codec.dumps(obj)
+        except (TypeError, ValueError, AttributeError, pickle.PicklingError) as exc:
+            logging.warning("Cache value can't be serialized: %s", exc)
+            return None
+
+    def encode_many(self, mapping):
+        encoded = ((key, self.encode(obj)) for key, obj in mapping.items())
+        return dict((key, data) for key, data in encoded if data is not None)
+
+    def decode(self, data):
+        """
+        Deserialize `data` with this backend's codec. Values that can't be
+        decoded (written with another codec, or corrupt) are treated as
+        misses: this logs a warning and returns None.
+        """
+        if data is None:
+            return None
+        try:
+            return self.codec.loads(data)
+        except Exception as exc:
+            logging.warning("Cache value can't be deserialized: %s", exc)
+            return None
+
+    def decode_many(self, found):
+        decoded = ((key, self.decode(data)) for key, data in found.items())
+        return dict((key, obj) for key, obj in decoded if obj is not None)
+
 class DatabaseKeyValue(GiottoKeyValue):
+    def __init__(self, codec='pickle', **kwargs):
+        self.codec = get_codec(codec)
 
     def get(self, key):
-        from giotto.djangoapp.models import DBKeyValue
-        return DBKeyValue.objects.cache_get(key)
+        from giotto.models import DBKeyValue
+        value = DBKeyValue.objects.cache_get(key)
+        return self.decode(value)
 
     def set(self, key, obj, expire):
-        from giotto.djangoapp.models import DBKeyValue
-        return DBKeyValue.objects.cache_set(key, obj, expire)
+        from giotto.models import DBKeyValue
+        data = self.encode(obj)
+        if data is not None:
+            DBKeyValue.objects.cache_set(key, data, expire)
+
+    def get_many(self, keys):
+        from giotto.models import DBKeyValue
+        found = DBKeyValue.objects.cache_get_many(keys)
+        return self.decode_many(found)
+
+    def set_many(self, mapping, expire):
+        from giotto.models import DBKeyValue
+        DBKeyValue.objects.cache_set_many(self.encode_many(mapping), expire)
+
+    def delete(self, key):
+        from giotto.models import DBKeyValue
+        DBKeyValue.objects.filter(key=key).delete()
+
+    def delete_many(self, keys):
+        from giotto.models import DBKeyValue
+        DBKeyValue.objects.filter(key__in=list(keys)).delete()
+
+    def acquire_lock(self, key, expire):
+        from giotto.models import DBKeyValue
+        return DBKeyValue.objects.acquire_lock(key, expire)
+
+    def release_lock(self, key):
+        from giotto.models import DBKeyValue
+        DBKeyValue.objects.filter(key=key).delete()
+
+def approximate_size(obj, depth=3):
+    """
+    Roughly how many bytes `obj` takes up in memory. Containers are walked
+    `depth` levels deep.
+    """
+    size = sys.getsizeof(obj)
+    if depth and hasattr(obj, 'items'):
+        for key, value in obj.items():
+            size += approximate_size(key, depth - 1) + approximate_size(value, depth - 1)
+    elif depth and type(obj) in (list, tuple, set):
+        for item in obj:
+            size += approximate_size(item, depth - 1)
+    return size
 
-locmem = {}
 class LocMemKeyValue(GiottoKeyValue):
     """
-    KeyValue backend that stores everything in a python dict.
+    KeyValue backend that stores everything in a python dict. The store is
+    bounded by number of entries and (approximate) total size in bytes. When
+    full, the least recently used keys are evicted. Expired keys are purged
+    in order of expiration with a heap, not only when they are read.
+    An expire of 0 means the key never expires.
     """
-    def get(self, key):
-        if key not in locmem:
-            return None
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024, **kwargs):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.data = OrderedDict() # key -> (obj, expires, size), oldest first
+        self.expiry_heap = [] # (expires, key)
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'entries': len(self.data),
+            'bytes': self.total_bytes,
+        }
 
-        result = locmem[key]
-        expire = result[1]
-        obj = result[0]
+    def _remove(self, key):
+        obj, expires, size = self.data.pop(key)
+        self.total_bytes -= size
 
-        if datetime.datetime.now() < expire:
-            return obj
+    def _purge_expired(self, now):
+        """
+        Pop every key off the expiry heap that has expired. Heap entries whose
+        key has been overwritten or removed since are skipped.
+        """
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, key = heapq.heappop(heap)
+            entry = self.data.get(key)
+            if entry and entry[1] == expires:
+                self._remove(key)
+                self.expirations += 1
 
-        del locmem[key]
-        return None # obj has expired.
+        if len(heap) > 2 * len(self.data) + 64:
+            # too many stale heap entries, rebuild it.
+            self.expiry_heap = [(e[1], k) for k, e in self.data.items() if e[1]]
+            heapq.heapify(self.expiry_heap)
+
+    def _evict(self):
+        while self.data and (
+                len(self.data) > self.max_entries or
+                (self.max_bytes and self.total_bytes > self.max_bytes)):
+            key = next(iter(self.data))
+            self._remove(key)
+            self.evictions += 1
+
+    def get(self, key):
+        with self.lock:
+            now = monotonic()
+            self._purge_expired(now)
+            entry = self.data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] and entry[1] <= now:
+                # obj has expired.
+                self.total_bytes -= entry[2]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.data[key] = entry # move to the most recently used end
+            self.hits += 1
+            return entry[0]
 
     def set(self, key, obj, expire):
-        when_expire = datetime.datetime.now() + datetime.timedelta(seconds=expire)
-        locmem[key] = (obj, when_expire)
+        size = approximate_size(obj) if self.max_bytes else 0
+        with self.lock:
+            now = monotonic()
+            self._purge_expired(now)
+            if key in self.data:
+                self._remove(key)
+
+            expires = (now + expire) if expire else 0
+            self.data[key] = (obj, expires, size)
+            self.total_bytes += size
+            if expires:
+                heapq.heappush(self.expiry_heap, (expires, key))
+            self._evict()
+
+    def get_many(self, keys):
+        with self.lock:
+            found = {}
+            for key in keys:
+                value = self.get(key)
+                if value is not None:
+                    found[key] = value
+            return found
+
+    def set_many(self, mapping, expire):
+        with self.lock:
+            for key, obj in mapping.items():
+                self.set(key, obj, expire)
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.data:
+                self._remove(key)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                if key in self.data:
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.expiry_heap = []
+            self.total_bytes = 0
+
 
+class CircuitBreaker(object):
+    """
+    Keeps track of failures talking to a cache server. After `threshold`
+    failures in a row the circuit opens, and for the next `retry_after` seconds
+    the server is not contacted at all; calls return their default right away,
+    so a cache outage makes every request a cache miss instead of an error.
+    """
+    def __init__(self, errors, threshold=5, retry_after=30):
+        self.errors = errors
+        self.threshold = threshold
+        self.retry_after = retry_after
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        if self.opened_at is None:
+            return False
+        if monotonic() - self.opened_at > self.retry_after:
+            # let the next call through to see if the server is back.
+            return False
+        return True
+
+    def call(self, default, func, *args, **kwargs):
+        if self.is_open():
+            return default
+        try:
+            result = func(*args, **kwargs)
+        except self.errors as exc:
+            with self.lock:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = monotonic()
+            logging.warning("Cache server error: %s", exc)
+            return default
+
+        if self.failures:
+            with self.lock:
+                self.failures = 0
+                self.opened_at = None
+        return result
 
 class MemcacheKeyValue(GiottoKeyValue):
-    def __init__(self, host=['localhost'], behavior={}):
+    """
+    pylibmc clients are not thread safe. By default each thread gets its own
+    client, pass in `pool_size` to share a fixed number of clients between
+    all threads instead. Without a codec, values are pickled by pylibmc.
+    """
+    def __init__(self, host=['localhost'], behavior={}, codec=None, pool_size=None,
+            failure_threshold=5, retry_after=30):
         if not pylibmc:
             msg = 'pylibmc not installed! install with: pip install pylibmc'
             raise ImportError(msg)
@@ -71,28 +458,296 @@ class MemcacheKeyValue(GiottoKeyValue):
         if behavior:
             kwargs['behavior'] = behavior
         self.client = pylibmc.Client(**kwargs)
+        if pool_size:
+            pool = pylibmc.ClientPool(self.client, pool_size)
+            self.reserve = lambda: pool.reserve(block=True)
+        else:
+            self.reserve = pylibmc.ThreadMappedPool(self.client).reserve
+        self.codec = codec and get_codec(codec)
+        self.breaker = CircuitBreaker(pylibmc.Error, failure_threshold, retry_after)
+
+    def call(self, default, method, *args, **kwargs):
+        """
+        Call `method` on a client from the pool, through the circuit breaker.
+        """
+        def run():
+            with self.reserve() as client:
+                return getattr(client, method)(*args, **kwargs)
+        return self.breaker.call(default, run)
 
     def set(self, key, obj, expire):
-        self.client.set(str(key), obj, time=expire)
+        if self.codec:
+            obj = self.encode(obj)
+            if obj is None:
+                return
+        self.call(None, 'set', str(key), obj, time=expire)
 
     def get(self, key):
-        return self.client.get(str(key))
+        value = self.call(None, 'get', str(key))
+        if not self.codec:
+            return value
+        return self.decode(value)
+
+    def get_many(self, keys):
+        keys = dict((str(key), key) for key in keys)
+        found = self.call({}, 'get_multi', list(keys.keys()))
+        if self.codec:
+            found = self.decode_many(found)
+        return dict((keys[k], v) for k, v in found.items())
+
+    def set_many(self, mapping, expire):
+        if self.codec:
+            mapping = self.encode_many(mapping)
+        mapping = dict((str(k), v) for k, v in mapping.items())
+        self.call(None, 'set_multi', mapping, time=expire)
+
+    def delete(self, key):
+        self.call(None, 'delete', str(key))
+
+    def delete_many(self, keys):
+        self.call(None, 'delete_multi', [str(key) for key in keys])
+
+    def acquire_lock(self, key, expire):
+        # `add` only succeeds when the key does not exist yet. When memcache
+        # is down, let the caller go ahead and calculate the value.
+        return bool(self.call(True, 'add', str(key), 1, time=expire))
+
+    def release_lock(self, key):
+        self.call(None, 'delete', str(key))
 
 class RedisKeyValue(GiottoKeyValue):
-    def __init__(self, host='localhost', port=6379, db=0):
+    """
+    All threads share one connection pool of at most `max_connections`
+    connections. The timeouts are in seconds; they make a server that stops
+    answering count as a failure for the circuit breaker, instead of
+    blocking requests forever.
+    """
+    def __init__(self, host='localhost', port=6379, db=0, codec='pickle',
+            max_connections=None, socket_timeout=0.5, socket_connect_timeout=0.5,
+            failure_threshold=5, retry_after=30):
         if not redis:
             msg = 'redis python wrapper not installed! install with: pip install redis'
             raise ImportError(msg)
-        self.redis = redis.StrictRedis(host=host, port=port, db=db)
+        self.pool = redis.ConnectionPool(
+            host=host, port=port, db=db, max_connections=max_connections,
+            socket_timeout=socket_timeout, socket_connect_timeout=socket_connect_timeout,
+        )
+        self.redis = redis.StrictRedis(connection_pool=self.pool)
+        self.codec = get_codec(codec)
+        self.breaker = CircuitBreaker(redis.RedisError, failure_threshold, retry_after)
 
     def set(self, key, obj, expire):
-        self.redis.setex(key, expire, pickle.dumps(obj))
+        data = self.encode(obj)
+        if data is not None:
+            self.breaker.call(None, self.redis.setex, key, expire, data)
 
     def get(self, key):
-        pickled_value = self.redis.get(key)
-        if pickled_value is None:
-            return None
-        return pickle.loads(pickled_value)
+        value = self.breaker.call(None, self.redis.get, key)
+        return self.decode(value)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.breaker.call([None] * len(keys), self.redis.mget, keys)
+        return self.decode_many(dict(
+            (key, value) for key, value in zip(keys, values) if value is not None
+        ))
+
+    def set_many(self, mapping, expire):
+        pipe = self.redis.pipeline()
+        for key, data in self.encode_many(mapping).items():
+            pipe.setex(key, expire, data)
+        self.breaker.call(None, pipe.execute)
+
+    def delete(self, key):
+        self.breaker.call(None, self.redis.delete, key)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if keys:
+            self.breaker.call(None, self.redis.delete, *keys)
+
+    def acquire_lock(self, key, expire):
+        # when redis is down, let the caller go ahead and calculate the value.
+        return bool(self.breaker.call(True, self.redis.set, key, 1, nx=True, ex=expire))
+
+    def release_lock(self, key):
+        self.breaker.call(None, self.redis.delete, key)
+
+    def listener_client(self):
+        """
+        A client with a connection pool of its own, for waiting on pub/sub
+        messages. Its connections have no socket timeout, since an idle
+        channel is not an error. TCP keepalive notices a dead server instead.
+        """
+        kwargs = dict(self.pool.connection_kwargs, socket_timeout=None, socket_keepalive=True)
+        return redis.StrictRedis(connection_pool=redis.ConnectionPool(**kwargs))
+
+class TieredKeyValue(GiottoKeyValue):
+    """
+    Keeps a small in-process LRU cache (the L1) in front of another backend,
+    such as redis or memcache. Values are kept in the L1 for `local_expire`
+    seconds at most, so most hits don't have to go over the network.
+
+    When one process sets a key, other processes drop it from their L1. With
+    redis this is done through pub/sub. Other backends store a version counter
+    that gets bumped on each set; each process checks it every
+    `version_check_interval` seconds and clears its L1 when it has changed.
+    """
+    channel = 'giotto-keyvalue-invalidate'
+    version_key = 'giotto-keyvalue-version'
+
+    def __init__(self, backend='redis', host='localhost', local_expire=5,
+            local_max_entries=1000, version_check_interval=1, **kwargs):
+        if hasattr(backend, 'lower'):
+            from giotto.utils import switchout_keyvalue
+            backend = switchout_keyvalue(backend)(host=host, **kwargs)
+        self.backend = backend
+        self.local = LocMemKeyValue(max_entries=local_max_entries)
+        self.local_expire = local_expire
+        self.version_check_interval = version_check_interval
+        self.id = uuid.uuid4().hex
+
+        self.pubsub = isinstance(backend, RedisKeyValue)
+        if self.pubsub:
+            self.listener_pid = None
+            self.listener_lock = threading.Lock()
+        else:
+            self.version = None
+            self.version_checked = 0
+
+    def start_listener(self):
+        """
+        Start the pub/sub listener thread, the first time this is called in
+        each process. Threads don't survive a fork, so a worker forked by a
+        server that created this object before forking starts its own.
+        The forked process also gets its own id, and drops the L1 it got
+        from its parent, since it missed the messages sent in the meantime.
+        """
+        pid = os.getpid()
+        if self.listener_pid == pid:
+            return
+        with self.listener_lock:
+            if self.listener_pid == pid:
+                return
+            if self.listener_pid is not None:
+                self.id = uuid.uuid4().hex
+                self.local.clear()
+            self.listener_pid = pid
+            thread = threading.Thread(target=self.listen)
+            thread.daemon = True
+            thread.start()
+
+    def listen(self):
+        """
+        Drop keys from the L1 when another process announces it set them.
+        """
+        client = self.backend.listener_client()
+        while True:
+            pubsub = client.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = message['data']
+                    if not hasattr(data, 'encode'):
+                        data = data.decode('utf-8')
+                    sender, keys = data.split(':', 1)
+                    if sender != self.id:
+                        self.local.delete_many(keys.split('\n'))
+            except redis.RedisError:
+                # connection lost, anything could have changed in the meantime.
+                self.local.clear()
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    def check_version(self):
+        now = monotonic()
+        if now - self.version_checked < self.version_check_interval:
+            return
+        self.version_checked = now
+        version = self.backend.get(self.version_key)
+        if version != self.version:
+            self.local.clear()
+            self.version = version
+
+    def invalidate(self, *keys):
+        """
+        Tell the other processes that `keys` have changed, with a single
+        message (or version bump) for all of them.
+        """
+        if not keys:
+            return
+        if self.pubsub:
+            self.start_listener()
+            message = "%s:%s" % (self.id, '\n'.join(keys))
+            self.backend.breaker.call(None, self.backend.redis.publish, self.channel, message)
+        else:
+            self.version = uuid.uuid4().hex
+            self.backend.set(self.version_key, self.version, 24 * 3600)
+
+    def get(self, key):
+        if self.pubsub:
+            self.start_listener()
+        else:
+            self.check_version()
+
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        value = self.backend.get(key)
+        if value is not None:
+            self.local.set(key, value, self.local_expire)
+        return value
+
+    def set(self, key, obj, expire):
+        self.backend.set(key, obj, expire)
+        self.local.set(key, obj, self.get_local_expire(expire))
+        self.invalidate(key)
+
+    def get_local_expire(self, expire):
+        return min(expire, self.local_expire) if expire else self.local_expire
+
+    def get_many(self, keys):
+        if self.pubsub:
+            self.start_listener()
+        else:
+            self.check_version()
+
+        keys = list(keys)
+        found = self.local.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            from_backend = self.backend.get_many(missing)
+            self.local.set_many(from_backend, self.local_expire)
+            found.update(from_backend)
+        return found
+
+    def set_many(self, mapping, expire):
+        self.backend.set_many(mapping, expire)
+        self.local.set_many(mapping, self.get_local_expire(expire))
+        self.invalidate(*mapping.keys())
+
+    def delete(self, key):
+        self.backend.delete(key)
+        self.local.delete(key)
+        self.invalidate(key)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        self.backend.delete_many(keys)
+        self.local.delete_many(keys)
+        self.invalidate(*keys)
+
+    def acquire_lock(self, key, expire):
+        return self.backend.acquire_lock(key, expire)
+
+    def release_lock(self, key):
+        return self.backend.release_lock(key)
 
 class DummyKeyValue(GiottoKeyValue):
     """
@@ -102,4 +757,142 @@ class DummyKeyValue(GiottoKeyValue):
         return None
 
     def get(self, key):
-        return None
\ No newline at end of file
+        return None
+
+    def delete(self, key):
+        return None
+
+class Flight(object):
+    """
+    A calculation of a cache value that is in progress in this process.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.done = False
+        self.result = None
+
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+def single_flight(cache, key, compute, lock_expire=30, poll_interval=0.05):
+    """
+    Call `compute` (which is expected to store its result in `cache` under `key`)
+    and return its result, making sure only one caller at a time is computing
+    the value for `key`. Other threads in this process wait for the result of
+    that call. Other processes (when the backend is shared, such as redis)
+    are kept out with a lock key, and poll the cache for the result. If the
+    result never shows up within `lock_expire` seconds, compute is called anyway.
+    """
+    with in_flight_lock:
+        flight = in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = in_flight[key] = Flight()
+
+    if not leader:
+        flight.event.wait(lock_expire)
+        if flight.done:
+            return flight.result
+        # the call in the other thread failed or is taking too long.
+        return compute()
+
+    try:
+        flight.result = coalesce_across_processes(
+            cache, key, compute, lock_expire, poll_interval
+        )
+        flight.done = True
+        return flight.result
+    finally:
+        with in_flight_lock:
+            del in_flight[key]
+        flight.event.set()
+
+def coalesce_across_processes(cache, key, compute, lock_expire, poll_interval):
+    lock_key = "lock:%s" % key
+    deadline = monotonic() + lock_expire
+    while monotonic() < deadline:
+        if cache.acquire_lock(lock_key, lock_expire):
+            try:
+                return compute()
+            finally:
+                cache.release_lock(lock_key)
+
+        # another process is calculating this value, wait for it.
+        time.sleep(poll_interval)
+        hit = cache.get(key)
+        if hit:
+            return hit
+
+    return compute()
+
+refreshing = set()
+
+def refresh_in_background(cache, key, compute, lock_expire=30):
+    """
+    Call `compute` (which stores a fresh value for `key` in `cache`) in a
+    background thread. Only one refresh per key runs at a time, in this
+    process (and across processes, if the backend supports locks).
+    """
+    with in_flight_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+
+    def refresh():
+        lock_key = "lock:%s" % key
+        try:
+            if cache.acquire_lock(lock_key, lock_expire):
+                try:
+                    compute()
+                finally:
+                    cache.release_lock(lock_key)
+        except Exception:
+            logging.exception("Refreshing cache key %s failed", key)
+        finally:
+            with in_flight_lock:
+                refreshing.discard(key)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+# generation keys live for 30 days (the longest relative expire memcache allows)
+TAG_EXPIRE = 30 * 24 * 3600
+
+def get_tag_key(tag):
+    return "tag-generation:%s" % tag
+
+def get_tag_generations(cache, tags):
+    """
+    Return the current generation of each tag, as a {tag: generation} dict.
+    Tags that have no generation yet get one. Generations are random tokens
+    instead of plain counters, so a generation key that gets evicted can't
+    bring back values that were cached under an earlier generation.
+    """
+    tags = sorted(set(tags))
+    found = cache.get_many([get_tag_key(tag) for tag in tags])
+    generations = {}
+    new = {}
+    for tag in tags:
+        generation = found.get(get_tag_key(tag))
+        if generation is None:
+            generation = new[get_tag_key(tag)] = uuid.uuid4().hex[:12]
+        generations[tag] = generation
+
+    if new:
+        cache.set_many(new, TAG_EXPIRE)
+    return generations
+
+def invalidate_tags(tags, cache=None):
+    """
+    Invalidate all cached values that were stored with any of `tags` by giving
+    each tag a new generation. `cache` defaults to the configured cache engine.
+    """
+    if hasattr(tags, 'lower'):
+        tags = [tags]
+    if cache is None:
+        from giotto import get_config
+        cache = get_config('cache_engine', DummyKeyValue())
+    cache.set_many(
+        dict((get_tag_key(tag), uuid.uuid4().hex[:12]) for tag in tags), TAG_EXPIRE
+    )
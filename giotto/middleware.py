@@ -1,3 +1,8 @@
+import six
+
+from giotto.utils import is_compressible, compress, compress_encodings
+from giotto.controllers.http import compress_response
+
 class GiottoOutputMiddleware(object):
     def __init__(self, controller):
         self.controller = controller
@@ -12,4 +17,28 @@ class RenderLazytemplate(GiottoOutputMiddleware):
         if engine == 'jinja2':
             rendered = template.render(**context)
         response.text = rendered
-        return response
\ No newline at end of file
+        return response
+
+class CompressResponse(GiottoOutputMiddleware):
+    """
+    Compress responses with gzip or brotli, depending on the request's
+    Accept-Encoding header. Put this last in `output_middleware`.
+    When the program is cached, the body is compressed once when it is
+    stored in the cache, instead of on each hit.
+    """
+    min_size = 1024
+    level = 5
+
+    def http(self, request, response):
+        return compress_response(request, response, self.min_size, self.level)
+
+    def before_cache(self, response):
+        body = response.get('body')
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+        if (isinstance(body, six.binary_type) and len(body) >= self.min_size
+                and is_compressible(response.get('mimetype'))):
+            response['compressed'] = dict(
+                (encoding, compress(body, encoding, self.level)) for encoding in compress_encodings
+            )
+        return response
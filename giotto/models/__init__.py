@@ -1,34 +1,120 @@
 import datetime
-import pickle
 import re
 import bcrypt
 
 from giotto import get_config
 from giotto.exceptions import InvalidInput
 
-from django.db import models
+from django.db import models, connections, transaction, IntegrityError
+
+# expiration date stored for keys that never expire (expire of 0)
+NEVER_EXPIRE = datetime.datetime(9999, 1, 1)
 
 class DBKeyValueManager(models.Manager):
-    def cache_set(self, key, obj, expire):
-        p = pickle.dumps(obj)
-        when_expire = datetime.datetime.now() + datetime.timedelta(seconds=expire)
-        exists = self.filter(key=key, expires__lt=datetime.datetime.now()).exists()
-        if exists:
-            self.filter(key=key).update(value=p, expires=when_expire)
+    def get_expires(self, expire):
+        if not expire:
+            return NEVER_EXPIRE
+        return datetime.datetime.now() + datetime.timedelta(seconds=expire)
+
+    def cache_set(self, key, value, expire):
+        """
+        Store `value`, an already encoded value (see giotto.keyvalue.Codec).
+        """
+        self.cache_set_many({key: value}, expire)
+
+    def cache_set_many(self, mapping, expire):
+        """
+        Insert or update all keys in `mapping` with a single upsert query.
+        Databases that don't support upserts fall back to an update, and then
+        an insert if nothing was updated.
+        """
+        if not mapping:
+            return
+        when_expire = self.get_expires(expire)
+        connection = connections[self.db]
+        vendor = connection.vendor
+
+        if vendor not in ('sqlite', 'postgresql', 'mysql'):
+            for key, value in mapping.items():
+                if not self.filter(key=key).update(value=value, expires=when_expire):
+                    self.create(key=key, value=value, expires=when_expire)
+            return
+
+        qn = connection.ops.quote_name
+        meta = self.model._meta
+        names = {
+            'table': qn(meta.db_table),
+            'key': qn(meta.get_field('key').column),
+            'value': qn(meta.get_field('value').column),
+            'expires': qn(meta.get_field('expires').column),
+        }
+        sql = "INSERT INTO %(table)s (%(key)s, %(value)s, %(expires)s) VALUES " % names
+        sql += ", ".join(["(%s, %s, %s)"] * len(mapping))
+        if vendor == 'mysql':
+            sql += (
+                " ON DUPLICATE KEY UPDATE %(value)s = VALUES(%(value)s),"
+                " %(expires)s = VALUES(%(expires)s)" % names
+            )
         else:
-            self.create(key=key, value=p, expires=when_expire)
+            sql += (
+                " ON CONFLICT (%(key)s) DO UPDATE SET %(value)s = excluded.%(value)s,"
+                " %(expires)s = excluded.%(expires)s" % names
+            )
+
+        value_field = meta.get_field('value')
+        expires = meta.get_field('expires').get_db_prep_value(when_expire, connection)
+        params = []
+        for key, value in mapping.items():
+            params.extend([key, value_field.get_db_prep_value(value, connection), expires])
+
+        with transaction.atomic(using=self.db):
+            connection.cursor().execute(sql, params)
+
+    def acquire_lock(self, key, expire):
+        """
+        Insert a row for this lock. The primary key makes sure only one
+        process can hold it. Locks that have expired are cleared first.
+        """
+        self.filter(key=key, expires__lt=datetime.datetime.now()).delete()
+        try:
+            with transaction.atomic(using=self.db):
+                self.create(key=key, value=b'', expires=self.get_expires(expire))
+        except IntegrityError:
+            return False
+        return True
+
+    def cache_get_many(self, keys):
+        """
+        Fetch all unexpired keys with one query. Returns a {key: value} dict.
+        """
+        hits = self.filter(key__in=list(keys), expires__gt=datetime.datetime.now())
+        return dict((key, bytes(value)) for key, value in hits.values_list('key', 'value'))
 
     def cache_get(self, key):
         try:
-            hit = DBKeyValue.objects.get(key=key, expires__gt=datetime.datetime.now())
-            return pickle.loads(str(hit.value))
-        except DBKeyValue.DoesNotExist:
+            hit = self.get(key=key, expires__gt=datetime.datetime.now())
+            return bytes(hit.value)
+        except self.model.DoesNotExist:
             return None
 
+    def purge_expired(self, batch_size=1000):
+        """
+        Delete all expired keys, `batch_size` rows at a time so the table
+        doesn't stay locked for long. Returns how many rows were deleted.
+        """
+        deleted = 0
+        while True:
+            expired = self.filter(expires__lt=datetime.datetime.now())
+            keys = list(expired.values_list('key', flat=True)[:batch_size])
+            if not keys:
+                return deleted
+            self.filter(key__in=keys).delete()
+            deleted += len(keys)
+
 class DBKeyValue(models.Model):
     key = models.TextField(primary_key=True)
-    value = models.TextField()
-    expires = models.DateTimeField()
+    value = models.BinaryField()
+    expires = models.DateTimeField(db_index=True)
 
     objects = DBKeyValueManager()
 
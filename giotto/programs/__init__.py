@@ -1,4 +1,4 @@
-import inspect
+from collections import namedtuple
 try:
     from collections import OrderedDict
 except ImportError:
@@ -8,9 +8,17 @@ import re
 import os
 
 from giotto.exceptions import ProgramNotFound, MockNotFound, ControlMiddlewareInterrupt, NoViewMethod
-from giotto.utils import super_accept_to_mimetype
+from giotto.utils import super_accept_to_mimetype, getargspec
 from giotto.control import GiottoControl
 from giotto.views import GiottoView
+from giotto.primitives import GiottoPrimitive, RAW_INVOCATION_ARGS
+
+# The "binding plan" for a program's model. `args` and `kwargs` are what
+# `get_model_args_kwargs` returns. `fields` is a tuple of
+# (name, default, primitive, is_raw) tuples, one for each argument the model
+# takes, in order. `default` is NotImplemented when the model has no default for
+# that argument, `primitive` is the GiottoPrimitive default (or None).
+ModelBinding = namedtuple('ModelBinding', ['args', 'kwargs', 'fields', 'takes_raw'])
 
 class Program(object):
     name = None
@@ -20,13 +28,18 @@ class Program(object):
     input_middleware = ()
     controllers = ()
     cache = 0
+    cache_stale = 0
+    cache_vary = None
+    cache_tags = ()
+    cache_control = None
     model = ()
     view = None
     output_middleware = ()
 
     valid_args = [
         'name', 'description', 'tests', 'pre_input_middleware', 'controllers',
-        'input_middleware', 'cache', 'model', 'view', 'output_middleware'
+        'input_middleware', 'cache', 'cache_stale', 'cache_vary', 'cache_tags',
+        'cache_control', 'model', 'view', 'output_middleware'
     ]
 
     def __repr__(self):
@@ -49,26 +62,63 @@ class Program(object):
 
         m = self.get_model()
         self.name = (m and m.__name__) or kwargs.get('name')
+        self.model_binding = self.make_model_binding()
 
-    def get_model_args_kwargs(self):
+    def make_model_binding(self):
         """
-        Inspect the model (or view in the case of no model) and return the args
-        and kwargs. This functin is necessary because argspec returns in a silly format
-        by default.
+        Inspect the model once and build the plan the controller uses to bind
+        invocation data to model arguments. Nothing in here changes after
+        the program is created, so it is not re-calculated for every request.
         """
         source = self.get_model()
         if not source:
-            return [], {}
+            return ModelBinding((), OrderedDict(), (), False)
+
+        argspec = getargspec(source)
 
-        argspec = inspect.getargspec(source)
-        
         kk = list(zip(*[reversed(l) for l in (argspec.args, argspec.defaults or [])]))
         kk.reverse()
         kwargs = OrderedDict(kk)
         args = [x for x in argspec.args if x not in kwargs.keys()]
         if args and args[0] == 'cls':
             args = args[1:]
-        return args, kwargs
+
+        fields = []
+        for field in args + list(kwargs.keys()):
+            # NotImplemented is used here to preserve if a default value is None.
+            default = kwargs.get(field, NotImplemented)
+            primitive = default if type(default) == GiottoPrimitive else None
+            fields.append((field, default, primitive, default is RAW_INVOCATION_ARGS))
+
+        takes_raw = any(is_raw for name, default, primitive, is_raw in fields)
+        return ModelBinding(tuple(args), kwargs, tuple(fields), takes_raw)
+
+    def get_model_args_kwargs(self):
+        """
+        Return the args and kwargs of the model (from the binding plan).
+        """
+        binding = self.model_binding
+        return list(binding.args), OrderedDict(binding.kwargs)
+
+    def get_cache_tags(self, data):
+        """
+        Return the cache tags for a call to the model with `data`. Each tag
+        in `cache_tags` is either a string, which gets formatted with the
+        model arguments (eg: 'blog-{id}'), or a callable that takes the model
+        arguments and returns a tag or a list of tags.
+        """
+        tags = []
+        for tag in self.cache_tags:
+            if callable(tag):
+                tag = tag(data)
+            else:
+                tag = tag.format(**data)
+
+            if hasattr(tag, 'lower'):
+                tags.append(tag)
+            else:
+                tags.extend(tag)
+        return tags
 
     def get_model(self):
         if len(self.model) == 0:
@@ -115,6 +165,18 @@ class Program(object):
                 response = to_execute(request, response)
         return response
 
+    def execute_cache_middleware(self, response, controller):
+        """
+        Give the output middleware a chance to do expensive work on the
+        response data once, before it is stored in the cache, instead of on
+        every cache hit. Middleware opt in by defining a `before_cache` method.
+        """
+        for m in self.output_middleware:
+            before_cache = getattr(m(controller), 'before_cache', None)
+            if before_cache:
+                response = before_cache(response)
+        return response
+
     def execute_model(self, data):
         """
         Returns data from the model, if mock is defined, it returns that instead.
@@ -144,9 +206,25 @@ class Manifest(object):
     def __getitem__(self, key):
         return self.manifest[key]
 
+    def __setitem__(self, key, value):
+        if not key_regex.match(key):
+            raise ValueError("Invalid manifest key: %s" % key)
+        if type(value) is dict:
+            value = Manifest(value, backname=key)
+        if isinstance(value, Manifest):
+            value._parents.append(self)
+        self.manifest[key] = value
+        self.invalidate_routes()
+
+    def __delitem__(self, key):
+        del self.manifest[key]
+        self.invalidate_routes()
+
     def __init__(self, manifest, backname='root'):
         self.backname = backname
         self.manifest = manifest
+        self._routes = {} # compiled routing tries by controller tag
+        self._parents = [] # manifests that contain this manifest
         # any sub manifests, convert to manifests objects
         for key, item in self.manifest.items():
             type_ = type(item)
@@ -165,6 +243,61 @@ class Manifest(object):
                 msg = "Manifest value must be either: a program, a list of programs, or another manifest"
                 raise TypeError(msg)
 
+            if isinstance(self.manifest[key], Manifest):
+                self.manifest[key]._parents.append(self)
+
+    def invalidate_routes(self):
+        """
+        Throw away the compiled routing tries for this manifest and every
+        manifest that contains it. Gets called whenever the manifest is changed.
+        """
+        self._routes = {}
+        for parent in self._parents:
+            parent.invalidate_routes()
+
+    def compile_routes(self, controller_tag):
+        """
+        Build a trie of path segments out of all the urls that are valid for
+        this controller tag. Each node is a dict in the form of
+        {'children': {segment: node}, 'path': <url or None>}. A node with
+        a path is the end of a valid program url.
+        """
+        root = {'children': {}, 'path': None}
+        for url in self.get_urls(controllers=[controller_tag]):
+            node = root
+            if url != '/':
+                for segment in url[1:].split('/'):
+                    node = node['children'].setdefault(
+                        segment, {'children': {}, 'path': None}
+                    )
+            node['path'] = url
+
+        self._routes[controller_tag] = root
+        return root
+
+    def find_program_path(self, invocation, controller_tag):
+        """
+        Walk the routing trie and return the longest program url that
+        `invocation` starts with. Returns an empty string if there is no match.
+        """
+        node = self._routes.get(controller_tag) or self.compile_routes(controller_tag)
+        longest = node['path'] or ''
+        for segment in invocation[1:].split('/'):
+            child = node['children'].get(segment)
+            if not child and '.' in segment:
+                # superformat attached to the program name, eg: 'program.json'
+                child = node['children'].get(segment.split('.')[0])
+                if child and child['path']:
+                    longest = child['path']
+                break
+            if not child:
+                break
+            node = child
+            if node['path']:
+                longest = node['path']
+
+        return longest
+
     def get_urls(self, controllers=None, prefix_path=''):
         """
         Return a list of all valid urls (minus args and kwargs, just the program paths)
@@ -290,6 +423,20 @@ class Manifest(object):
 
         return result
 
+    def is_root_path(self, program_path):
+        """
+        Returns True if the program path points to the root program of a
+        manifest (the '' key) instead of to a program with a name.
+        """
+        if program_path == '/':
+            return True
+
+        result = self
+        for item in program_path[1:].split('/'):
+            result = result[item]
+
+        return isinstance(result, Manifest)
+
     def parse_invocation(self, invocation, controller_tag):
         """
         Given an invocation string, determine which part is the path, the program,
@@ -302,27 +449,19 @@ class Manifest(object):
         if invocation == '':
             invocation = '/'
 
-        all_programs = self.get_urls(controllers=[controller_tag])
-
-        matching_paths = set()
-        for program_path in sorted(all_programs):
-            if invocation.startswith(program_path):
-                matching_paths.add(program_path)
-
-        longest = ""
-        for path in matching_paths:
-            longest = path if len(path) > len(longest) else longest
-
-        matching_path = longest
-
-        program = self.get_program(matching_path, controller=controller_tag)
+        matching_path = self.find_program_path(invocation, controller_tag)
 
         if not matching_path:
             raise ProgramNotFound("Can't find %s" % invocation)
 
+        program = self.get_program(matching_path, controller=controller_tag)
+
         program_name = matching_path.split('/')[-1]
         path = "/".join(matching_path.split('/')[:-1]) + '/'
         args_fragment = invocation[len(matching_path):]
+        if matching_path == '/' and args_fragment and not args_fragment.startswith('.'):
+            # the slash of the root url is also the separator of the first arg
+            args_fragment = '/' + args_fragment
 
         superformat = None
         if args_fragment.startswith('.'):
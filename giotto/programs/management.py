@@ -1,7 +1,8 @@
 from giotto.programs import Program, Manifest
 from giotto.programs.shell import shell
-from giotto.programs.tables import syncdb, flush
+from giotto.programs.tables import syncdb, flush, purge_cache, reset_cache
 from giotto.views import BasicView
+from giotto.contrib.static.programs import build_static
 
 management_manifest = Manifest({
     'syncdb': Program(
@@ -16,6 +17,24 @@ management_manifest = Manifest({
         model=[flush],
         view=BasicView(),
     ),
+    'purge_cache': Program(
+        name="Purge Expired Cache",
+        controllers=['cmd'],
+        model=[purge_cache],
+        view=BasicView(),
+    ),
+    'reset_cache': Program(
+        name="Recreate Cache Table",
+        controllers=['cmd'],
+        model=[reset_cache],
+        view=BasicView(),
+    ),
+    'build_static': Program(
+        name="Build Static Files",
+        controllers=['cmd'],
+        model=[build_static],
+        view=BasicView(),
+    ),
     'shell': Program(
         name="Giotto Shell",
         controllers=['cmd'],
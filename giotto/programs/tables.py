@@ -12,4 +12,24 @@ def flush():
     """
     Drop all existing tables in the database, and then recreate them.
     """
-    return call_command('flush', traceback=True)
\ No newline at end of file
+    return call_command('flush', traceback=True)
+
+def purge_cache(batch_size=1000):
+    """
+    Delete all expired keys from the database keyvalue table.
+    """
+    from giotto.models import DBKeyValue
+    return DBKeyValue.objects.purge_expired(int(batch_size))
+
+def reset_cache():
+    """
+    Drop the database keyvalue table and create it again. Needed once when
+    upgrading from an older version of giotto, which stored the values as text.
+    Everything stored in the cache is lost.
+    """
+    from django.db import connections
+    from giotto.models import DBKeyValue
+    connection = connections[DBKeyValue.objects.db]
+    table = connection.ops.quote_name(DBKeyValue._meta.db_table)
+    connection.cursor().execute("DROP TABLE IF EXISTS %s" % table)
+    return syncdb()
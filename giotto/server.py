@@ -0,0 +1,317 @@
+"""
+A pre-forking, multi-threaded WSGI server for running giotto applications
+in production without an external server like uwsgi or gunicorn.
+"""
+import errno
+import gc
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue # python2
+
+try:
+    import resource
+except ImportError:
+    resource = None # windows
+
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+def get_memory_usage():
+    """
+    Memory used by this process right now (its resident set size), in
+    megabytes. Where there is no /proc (mac os), this is the peak memory
+    used instead, which a forked process inherits from its parent.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / (1024.0 * 1024)
+    except (IOError, OSError, IndexError, ValueError, AttributeError):
+        pass
+
+    if not resource:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / (1024.0 * 1024) # bytes
+    return maxrss / 1024.0 # kilobytes
+
+def prepare_for_fork():
+    """
+    Get this process ready to fork: database connections can't be shared
+    between processes, so they are closed (each child opens its own).
+    Objects that exist now are moved out of the garbage collector's
+    reach, so collections in the children don't copy their memory pages.
+    """
+    try:
+        from django.db import connections
+        for connection in connections.all():
+            connection.close()
+    except Exception:
+        pass # django not installed or not configured
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+class Worker(object):
+    """
+    A forked process that accepts connections on the shared listening socket
+    and hands them to a pool of threads. The worker stops accepting
+    connections after `max_requests` requests, or once it uses more than
+    `max_memory` megabytes, finishes the requests it already accepted, and exits.
+    The master then forks a fresh worker in its place. A connection that sends
+    or receives nothing for `timeout` seconds is dropped, so slow or idle
+    clients can't hold on to the threads.
+    """
+    def __init__(self, listener, application, threads=8, max_requests=0, max_memory=0, timeout=30):
+        self.listener = listener
+        self.timeout = timeout
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_memory = max_memory
+        self.alive = True
+        self.handled = 0
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        # one slot per thread, so a busy worker leaves new connections
+        # for the other workers to accept.
+        self.slots = threading.Semaphore(threads)
+
+        host, port = listener.getsockname()[:2]
+        self.server = WSGIServer((host, port), WSGIRequestHandler, bind_and_activate=False)
+        self.server.socket = listener
+        self.server.server_name = socket.getfqdn(host)
+        self.server.server_port = port
+        self.server.setup_environ()
+        self.server.set_app(application)
+
+    def stop(self, signum=None, frame=None):
+        self.alive = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        pool = [threading.Thread(target=self.handle_requests) for i in range(self.threads)]
+        for thread in pool:
+            thread.daemon = True
+            thread.start()
+
+        while self.alive:
+            self.slots.acquire()
+            if not self.accept():
+                self.slots.release()
+
+        # stop taking new connections, but finish the ones already accepted.
+        self.listener.close()
+        for thread in pool:
+            self.requests.put(None)
+        for thread in pool:
+            thread.join()
+
+    def accept(self):
+        """
+        Wait a bit for a new connection and queue it up for the thread pool.
+        Returns False if no connection was accepted.
+        """
+        try:
+            ready = select.select([self.listener], [], [], 0.5)[0]
+            if not ready or not self.alive:
+                return False
+            connection, address = self.listener.accept()
+        except (select.error, socket.error) as exc:
+            # another worker got the connection first, or a signal came in.
+            if exc.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+            return False
+
+        # the listener is non-blocking, the connection gets a deadline instead.
+        connection.settimeout(self.timeout)
+        self.requests.put((connection, address))
+        return True
+
+    def handle_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            connection, address = item
+            try:
+                self.server.finish_request(connection, address)
+            except Exception:
+                self.server.handle_error(connection, address)
+            finally:
+                self.server.shutdown_request(connection)
+                self.slots.release()
+            self.count_request()
+
+    def count_request(self):
+        with self.lock:
+            self.handled += 1
+            if self.max_requests and self.handled >= self.max_requests:
+                self.alive = False
+        if self.max_memory and get_memory_usage() > self.max_memory:
+            self.alive = False
+
+class PreforkServer(object):
+    """
+    Bind to `ip`:`port`, then fork `workers` worker processes that all accept
+    connections from that socket. Each worker serves requests with `threads`
+    threads. The application is loaded in the master before forking, so
+    workers share its memory copy-on-write instead of each loading their own.
+    Connections that stay idle for `timeout` seconds are closed.
+
+    Signals sent to the master:
+        SIGTERM, SIGINT - finish the requests in progress, then exit.
+        SIGHUP - gracefully replace every worker with a new one.
+    """
+    graceful_timeout = 30
+
+    def __init__(self, ip, port, application, workers=4, threads=8,
+                 max_requests=0, max_memory=0, backlog=128, timeout=30):
+        self.address = (ip, port)
+        self.application = application
+        self.num_workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.max_memory = max_memory
+        self.backlog = backlog
+        self.timeout = timeout
+        self.workers = set()
+        self.retiring = set()
+        self.running = False
+        self.restart_requested = False
+
+    def listen(self):
+        listener = socket.socket(socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(self.backlog)
+        # all workers wait on this socket, the ones that lose the race to
+        # accept a connection must not block.
+        listener.setblocking(False)
+        return listener
+
+    def preload(self):
+        prepare_for_fork()
+        if self.max_memory and get_memory_usage() >= self.max_memory:
+            # the workers would start out over the limit and exit after each request.
+            print("Warning: max_memory (%s MB) is less than the %d MB the application already uses" % (
+                self.max_memory, get_memory_usage()
+            ))
+
+    def spawn(self):
+        # a little randomness, so all workers don't restart at the same time
+        max_requests = self.max_requests
+        if max_requests:
+            max_requests += random.randint(0, max_requests // 10)
+
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return
+
+        exit_code = 0
+        try:
+            worker = Worker(
+                self.listener, self.application, self.threads, max_requests,
+                self.max_memory, self.timeout
+            )
+            worker.run()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def restart(self, signum=None, frame=None):
+        self.restart_requested = True
+
+    def run(self):
+        self.listener = self.listen()
+        self.preload()
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.restart)
+
+        print("Serving on %s:%s with %s workers of %s threads each" % (
+            self.address[0], self.address[1], self.num_workers, self.threads
+        ))
+
+        while self.running:
+            self.reap()
+            old_workers = set()
+            if self.restart_requested:
+                self.restart_requested = False
+                old_workers, self.workers = self.workers, set()
+
+            while len(self.workers) < self.num_workers:
+                self.spawn()
+
+            # the replacements are already running, so requests keep being
+            # served while the old workers finish up.
+            for pid in old_workers:
+                self.signal(pid, signal.SIGTERM)
+            self.retiring.update(old_workers)
+            time.sleep(0.2)
+
+        self.shutdown()
+
+    def reap(self):
+        """
+        Forget about workers that have exited.
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            self.workers.discard(pid)
+            self.retiring.discard(pid)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass # already gone
+
+    def shutdown(self):
+        """
+        Ask all workers to finish up, then kill the ones that take longer
+        than `graceful_timeout` seconds.
+        """
+        self.retiring.update(self.workers)
+        self.workers.clear()
+        for pid in self.retiring:
+            self.signal(pid, signal.SIGTERM)
+
+        deadline = time.time() + self.graceful_timeout
+        while self.retiring and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+
+        for pid in self.retiring:
+            self.signal(pid, signal.SIGKILL)
+        self.listener.close()
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import unittest
+
+import giotto
+from giotto import initialize
+from giotto.keyvalue import LocMemKeyValue
+from giotto.controllers.asgi import make_asgi_app, make_environ
+from giotto.programs import Program, Manifest
+from giotto.views import BasicView, GiottoView, renders
+
+calls = []
+
+async def counted_model(x=1):
+	calls.append(x)
+	return {'x': int(x), 'async': True}
+
+async def async_model(x=1):
+	await asyncio.sleep(0)
+	return {'x': int(x), 'async': True}
+
+def sync_model(x=1):
+	return {'x': int(x), 'async': False}
+
+class AsyncView(GiottoView):
+	@renders('text/plain')
+	async def plaintext(self, result):
+		await asyncio.sleep(0)
+		return "x is %s" % result['x']
+
+	@renders('text/html')
+	def html(self, result):
+		async def stream():
+			for i in range(result['x']):
+				yield "<p>%s</p>" % i
+		return stream()
+
+class MarkRequest(object):
+	def __init__(self, controller):
+		pass
+
+	async def http(self, request):
+		request.environ['HTTP_X_SEEN'] = 'yes'
+		return request
+
+manifest = Manifest({
+	'async': Program(model=[async_model], view=BasicView(html=lambda m: json.dumps(m))),
+	'cached': Program(model=[counted_model], view=BasicView(html=lambda m: json.dumps(m)), cache=10),
+	'sync': Program(model=[sync_model], view=BasicView(html=lambda m: json.dumps(m))),
+	'render': Program(model=[sync_model], view=AsyncView()),
+	'middleware': Program(
+		model=[lambda: None],
+		view=BasicView(html=lambda m: "ok"),
+		input_middleware=[MarkRequest],
+	),
+})
+
+def request(path, query=b'', headers=()):
+	"""
+	Run a request through the asgi app, returns the status, headers and body.
+	"""
+	app = make_asgi_app(manifest)
+	scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': list(headers)}
+	sent = []
+
+	async def receive():
+		return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+	async def send(message):
+		sent.append(message)
+
+	asyncio.run(app(scope, receive, send))
+	body = b''.join(m.get('body', b'') for m in sent[1:])
+	return sent[0]['status'], dict(sent[0]['headers']), body
+
+class ASGITest(unittest.TestCase):
+
+	def setUp(self):
+		initialize()
+		del calls[:]
+
+	def test_async_model(self):
+		status, headers, body = request('/async.html', b'x=3')
+		self.assertEquals(status, 200)
+		self.assertEquals(json.loads(body.decode()), {'x': 3, 'async': True})
+
+	def test_sync_model(self):
+		status, headers, body = request('/sync.html/5')
+		self.assertEquals(json.loads(body.decode()), {'x': 5, 'async': False})
+
+	def test_async_renderer(self):
+		status, headers, body = request('/render.txt/7')
+		self.assertEquals(body, b'x is 7')
+
+	def test_async_stream(self):
+		status, headers, body = request('/render.html/3')
+		self.assertEquals(body, b'<p>0</p><p>1</p><p>2</p>')
+
+	def test_async_middleware(self):
+		status, headers, body = request('/middleware')
+		self.assertEquals(body, b'ok')
+
+	def test_cached_async_model(self):
+		"""
+		The cache layer runs in a thread, and runs async models on the event loop.
+		"""
+		giotto._config.cache_engine = LocMemKeyValue()
+		first = request('/cached.html/2')[2]
+		self.assertEquals(request('/cached.html/2')[2], first)
+		self.assertEquals(len(calls), 1)
+
+	def test_disconnect(self):
+		"""
+		When the client disconnects before the body is all there,
+		the program is not run and nothing is sent.
+		"""
+		app = make_asgi_app(manifest)
+		scope = {'type': 'http', 'method': 'POST', 'path': '/cached.html', 'headers': []}
+		messages = [
+			{'type': 'http.request', 'body': b'x=', 'more_body': True},
+			{'type': 'http.disconnect'},
+		]
+		sent = []
+
+		async def receive():
+			return messages.pop(0)
+
+		async def send(message):
+			sent.append(message)
+
+		asyncio.run(app(scope, receive, send))
+		self.assertEquals(sent, [])
+		self.assertEquals(calls, [])
+
+	def test_repeated_headers(self):
+		"""
+		Repeated cookie headers are joined with '; ', other headers with ','.
+		"""
+		scope = {'method': 'GET', 'path': '/', 'headers': [
+			(b'cookie', b'a=1'), (b'cookie', b'b=2'),
+			(b'accept', b'text/html'), (b'accept', b'text/plain'),
+		]}
+		environ = make_environ(scope, b'')
+		self.assertEquals(environ['HTTP_COOKIE'], 'a=1; b=2')
+		self.assertEquals(environ['HTTP_ACCEPT'], 'text/html,text/plain')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,63 @@
+import sys
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import giotto
+from giotto import initialize
+from giotto.controllers.cmd import CMDController, CMDRequest
+from giotto.keyvalue import LocMemKeyValue
+from giotto.programs import Program, Manifest
+from giotto.views import GiottoView, renders
+
+calls = []
+
+def count(x):
+    calls.append(x)
+    return int(x)
+
+class StreamView(GiottoView):
+    @renders('text/x-cmd')
+    def cmd(self, result):
+        return (u"line é%s\n" % i for i in range(result))
+
+manifest = Manifest({
+    'stream': Program(model=[count], view=StreamView()),
+    'cached': Program(model=[count], view=StreamView(), cache=10),
+})
+
+class CMDStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        initialize()
+        del calls[:]
+        giotto._config.cache_engine = LocMemKeyValue()
+
+    def invoke(self, *argv):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            controller = CMDController(CMDRequest(['giotto'] + list(argv)), manifest)
+            controller.get_response()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_stream(self):
+        self.assertEquals(self.invoke('stream', '--x=2'), u"line é0\nline é1\n")
+
+    def test_cached_stream(self):
+        """
+        The streamed body is cached as bytes, both the first (streamed)
+        and the cached response are written out as text.
+        """
+        first = self.invoke('cached', '--x=2')
+        self.assertEquals(first, u"line é0\nline é1\n")
+        second = self.invoke('cached', '--x=2')
+        self.assertEquals(second, first + u"\n")
+        self.assertEquals(len(calls), 1)
+
+if __name__ == '__main__':
+    unittest.main()
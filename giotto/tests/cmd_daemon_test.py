@@ -0,0 +1,72 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from giotto import initialize
+from giotto.controllers.cmd import serve_daemon
+from giotto.programs import Program, Manifest
+from giotto.views import BasicView
+
+def echo(word='hi'):
+    return "%s %s" % (word, os.environ.get('GIOTTO_TEST', ''))
+
+def fail():
+    raise SystemExit(3)
+
+manifest = Manifest({
+    'echo': Program(model=[echo], view=BasicView(cmd=lambda m: m)),
+    'fail': Program(model=[fail], view=BasicView()),
+})
+
+client = """
+import sys
+from giotto.cmd_client import run_through_daemon
+run_through_daemon(sys.argv[1:], %r)
+print("not handled by the daemon")
+"""
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg'), "needs unix sockets")
+class CMDDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        initialize()
+        self.socket_path = os.path.join(tempfile.mkdtemp(), 'cmd_daemon.sock')
+        self.daemon = os.fork()
+        if not self.daemon:
+            try:
+                sys.stdout = open(os.devnull, 'w')
+                serve_daemon(manifest, self.socket_path)
+            finally:
+                os._exit(0)
+
+        deadline = time.time() + 5
+        while not os.path.exists(self.socket_path) and time.time() < deadline:
+            time.sleep(0.02)
+
+    def tearDown(self):
+        os.kill(self.daemon, signal.SIGINT)
+        os.waitpid(self.daemon, 0)
+        os.rmdir(os.path.dirname(self.socket_path))
+
+    def invoke(self, *argv):
+        env = dict(os.environ, GIOTTO_TEST='from-client')
+        process = subprocess.Popen(
+            [sys.executable, '-c', client % self.socket_path, 'giotto-cmd'] + list(argv),
+            stdout=subprocess.PIPE, env=env,
+        )
+        stdout = process.communicate()[0]
+        return process.returncode, stdout.decode('utf-8')
+
+    def test_invocation(self):
+        self.assertEquals(self.invoke('echo', '--word=yo'), (0, "yo from-client\n"))
+
+    def test_exit_code(self):
+        self.assertEquals(self.invoke('fail')[0], 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import datetime
+import unittest
+
+import django
+from django.conf import settings
+from django.db import connection
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        INSTALLED_APPS=('giotto',),
+        USE_TZ=False,
+    )
+    if hasattr(django, 'setup'):
+        django.setup()
+
+from giotto.keyvalue import DatabaseKeyValue
+from giotto.models import DBKeyValue
+
+def create_table():
+    if hasattr(connection, 'schema_editor'):
+        with connection.schema_editor() as editor:
+            editor.create_model(DBKeyValue)
+    else:
+        from django.core.management import call_command
+        call_command('syncdb', verbosity=0)
+
+create_table()
+
+class DatabaseKeyValueTest(unittest.TestCase):
+
+    def setUp(self):
+        DBKeyValue.objects.all().delete()
+        self.kv = DatabaseKeyValue()
+
+    def expire_now(self, *keys):
+        past = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        DBKeyValue.objects.filter(key__in=keys).update(expires=past)
+
+    def test_set_get(self):
+        self.kv.set('key', {'a': [1, 2]}, 10)
+        self.assertEqual(self.kv.get('key'), {'a': [1, 2]})
+        self.assertEqual(self.kv.get('missing'), None)
+
+    def test_overwrite(self):
+        """
+        Setting a key that exists (and has not expired) updates it in place.
+        """
+        self.kv.set('key', 'one', 10)
+        self.kv.set('key', 'two', 10)
+        self.assertEqual(self.kv.get('key'), 'two')
+        self.assertEqual(DBKeyValue.objects.count(), 1)
+
+    def test_expired(self):
+        self.kv.set('key', 'one', 10)
+        self.expire_now('key')
+        self.assertEqual(self.kv.get('key'), None)
+        self.kv.set('key', 'two', 10)
+        self.assertEqual(self.kv.get('key'), 'two')
+
+    def test_never_expire(self):
+        self.kv.set('key', 'value', 0)
+        self.assertEqual(DBKeyValue.objects.get(key='key').expires.year, 9999)
+        self.assertEqual(self.kv.get('key'), 'value')
+
+    def test_foreign_values(self):
+        """
+        Rows written with another codec (or by older versions of giotto)
+        are misses, not errors.
+        """
+        DBKeyValue.objects.cache_set('json', DatabaseKeyValue(codec='json').codec.dumps([1]), 10)
+        DBKeyValue.objects.cache_set('raw', b'not encoded at all', 10)
+        self.kv.set('good', 'value', 10)
+        self.assertEqual(self.kv.get('json'), None)
+        self.assertEqual(self.kv.get('raw'), None)
+        self.assertEqual(self.kv.get_many(['json', 'raw', 'good']), {'good': 'value'})
+
+    def test_many(self):
+        self.kv.set('a', 'old', 10)
+        self.kv.set_many({'a': 1, 'b': b'\x00\xff'}, 10)
+        self.assertEqual(self.kv.get_many(['a', 'b', 'c']), {'a': 1, 'b': b'\x00\xff'})
+        self.kv.delete_many(['a', 'b'])
+        self.assertEqual(self.kv.get_many(['a', 'b']), {})
+
+    def test_lock(self):
+        self.assertTrue(self.kv.acquire_lock('lock', 10))
+        self.assertFalse(self.kv.acquire_lock('lock', 10))
+        self.kv.release_lock('lock')
+        self.assertTrue(self.kv.acquire_lock('lock', 10))
+
+    def test_expired_lock(self):
+        """
+        A lock left behind by a process that died can be taken once it expires.
+        """
+        self.assertTrue(self.kv.acquire_lock('lock', 10))
+        self.expire_now('lock')
+        self.assertTrue(self.kv.acquire_lock('lock', 10))
+
+    def test_purge_expired(self):
+        self.kv.set_many(dict(('key%s' % i, i) for i in range(5)), 10)
+        self.kv.set('live', 'value', 10)
+        self.expire_now(*['key%s' % i for i in range(5)])
+        self.assertEqual(DBKeyValue.objects.purge_expired(batch_size=2), 5)
+        self.assertEqual(list(DBKeyValue.objects.values_list('key', flat=True)), ['live'])
+
+if __name__ == '__main__':
+    unittest.main()
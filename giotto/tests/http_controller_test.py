@@ -1,12 +1,20 @@
 import unittest
 import json
+import os
+import shutil
+import tempfile
+import time
 
+import giotto
 from giotto import initialize
-from giotto.controllers.http import HTTPController
+from giotto.keyvalue import LocMemKeyValue, refreshing, invalidate_tags
+from giotto.controllers.http import HTTPController, make_app, compress_middleware
+from giotto.middleware import CompressResponse, GiottoOutputMiddleware
 from giotto.programs import Program, Manifest
 from giotto.exceptions import ProgramNotFound, InvalidInvocation
 from giotto.primitives import LOGGED_IN_USER, RAW_INVOCATION_ARGS
-from giotto.views import BasicView
+from giotto.views import BasicView, GiottoView, renders
+from giotto.contrib.static.programs import StaticServe, build_static, static_url
 
 from webob import Request
 
@@ -75,6 +83,22 @@ class FoldingBaseArgTest(unittest.TestCase):
 		cx = HTTPController(request, self.manifest)
 		self.assertRaises(ProgramNotFound, cx.get_data_response)
 
+	def test_partial_name_404(self):
+		"""
+		A name that only starts with the name of a program is a 404 too.
+		"""
+		request = make_request("/namedfoo")
+		cx = HTTPController(request, self.manifest)
+		self.assertRaises(ProgramNotFound, cx.get_data_response)
+
+	def test_raw_root(self):
+		"""
+		A root program that takes the raw invocation gets the unmatched path.
+		"""
+		self.manifest[''] = Program(model=[raw], view=BasicView())
+		cx = HTTPController(make_request("/some/path"), self.manifest)
+		self.assertEquals(cx.get_data_for_model(), {'path': 'some/path', 'another': 3})
+
 class NegotiationTest(unittest.TestCase):
 
 	def setUp(self):
@@ -168,4 +192,383 @@ class NegotiationTest(unittest.TestCase):
 		request = make_request("/raw.json/raw/arg/to_some/program")
 		c = HTTPController(request, self.manifest)
 		data = c.get_data_response()
-		self.assertEquals(json.loads(data['body']), "raw/arg/to_some/program3")
\ No newline at end of file
+		self.assertEquals(json.loads(data['body']), "raw/arg/to_some/program3")
+
+	def test_raw_primitive_after_args(self):
+		"""
+		Positional args don't go to the fields that come before the raw primitive.
+		"""
+		def late_raw(x='x', path=RAW_INVOCATION_ARGS):
+			return x + path
+		self.manifest['late_raw'] = Program(model=[late_raw], view=BasicView())
+		c = HTTPController(make_request("/late_raw/a/b"), self.manifest)
+		self.assertEquals(c.get_data_for_model(), {'x': 'x', 'path': 'a/b'})
+
+calls = []
+def counted(x=1):
+	"counted"
+	calls.append(x)
+	return len(calls)
+
+class CacheTest(unittest.TestCase):
+
+	def setUp(self):
+		initialize()
+		del calls[:]
+		self.cache = LocMemKeyValue()
+		giotto._config.cache_engine = self.cache
+		self.manifest = Manifest({
+			'cached': Program(
+				model=[counted],
+				view=BasicView(),
+				cache=10,
+			),
+			'vary': Program(
+				model=[counted],
+				view=BasicView(),
+				cache=10,
+				cache_vary=[],
+				cache_control=60,
+			),
+			'tagged': Program(
+				model=[counted],
+				view=BasicView(),
+				cache=10,
+				cache_tags=['counted-{x}'],
+			),
+			'stale': Program(
+				model=[counted],
+				view=BasicView(),
+				cache=10,
+				cache_stale=100,
+			),
+		})
+
+	def get(self, path):
+		c = HTTPController(make_request(path), self.manifest)
+		return json.loads(c.get_data_response()['body'])
+
+	def test_cache_hit(self):
+		self.assertEquals(self.get("/cached.json/3"), 1)
+		self.assertEquals(self.get("/cached.json/3"), 1)
+		self.assertEquals(self.get("/cached.json/4"), 2)
+
+	def test_cache_vary(self):
+		"""
+		Only the arguments listed in `cache_vary` are part of the cache key,
+		and programs sharing a model don't share cache keys.
+		"""
+		self.assertEquals(self.get("/vary.json/3"), 1)
+		self.assertEquals(self.get("/vary.json/4"), 1)
+		self.assertEquals(self.get("/cached.json/3"), 2)
+
+	def test_cache_tags(self):
+		"""
+		Invalidating a tag only recalculates the values stored with that tag.
+		"""
+		self.assertEquals(self.get("/tagged.json/3"), 1)
+		self.assertEquals(self.get("/tagged.json/4"), 2)
+		invalidate_tags('counted-3', cache=self.cache)
+		self.assertEquals(self.get("/tagged.json/3"), 3)
+		self.assertEquals(self.get("/tagged.json/4"), 2)
+
+	def test_stale_while_revalidate(self):
+		"""
+		A stale response is served while it gets recalculated in the background.
+		"""
+		self.assertEquals(self.get("/stale.json"), 1)
+		for key, entry in self.cache.data.items():
+			entry[0]['stale_after'] = time.time() - 1
+
+		self.assertEquals(self.get("/stale.json"), 1)
+		for x in range(100):
+			if len(calls) == 2 and not refreshing:
+				break
+			time.sleep(0.01)
+		self.assertEquals(self.get("/stale.json"), 2)
+
+	def test_conditional_request(self):
+		"""
+		The etag of a cached response is stored with it, and requests that
+		already have it get a 304.
+		"""
+		app = make_app(self.manifest)
+		first = Request.blank('/vary/3').get_response(app)
+		self.assertEquals(first.status_int, 200)
+		self.assertTrue(first.last_modified)
+		self.assertEquals(first.cache_control.max_age, 60)
+
+		request = Request.blank('/vary/3', headers={'If-None-Match': first.headers['ETag']})
+		second = request.get_response(app)
+		self.assertEquals(second.status_int, 304)
+		self.assertEquals(second.body, b'')
+		self.assertEquals(len(calls), 1)
+
+def greeting():
+	counted()
+	return "<p>hello {{ user }}</p>" * 100
+
+class Personalize(GiottoOutputMiddleware):
+	def http(self, request, response):
+		response.text = response.text.replace('{{ user }}', request.GET.get('u', ''))
+		return response
+
+class PersonalizeTest(unittest.TestCase):
+	"""
+	Output middleware that rewrites the body of a cached response.
+	"""
+	def setUp(self):
+		initialize()
+		del calls[:]
+		giotto._config.cache_engine = LocMemKeyValue()
+		html = BasicView(html=lambda m: m)
+		self.app = make_app(Manifest({
+			'page': Program(model=[greeting], view=html, output_middleware=[Personalize], cache=10),
+			'compressed': Program(
+				model=[greeting], view=html, output_middleware=[Personalize, CompressResponse], cache=10
+			),
+		}))
+
+	def get(self, path, **headers):
+		return Request.blank(path, headers=headers).get_response(self.app)
+
+	def test_etag(self):
+		alice = self.get('/page?u=alice')
+		bob = self.get('/page?u=bob')
+		self.assertTrue(b'hello alice' in alice.body)
+		self.assertTrue(b'hello bob' in bob.body)
+		self.assertNotEquals(alice.etag, bob.etag)
+		self.assertEquals(bob.last_modified, None)
+		self.assertEquals(len(calls), 1)
+
+		again = self.get('/page?u=alice', **{'If-None-Match': alice.headers['ETag']})
+		self.assertEquals(again.status_int, 304)
+		other = self.get('/page?u=bob', **{'If-None-Match': alice.headers['ETag']})
+		self.assertEquals(other.status_int, 200)
+
+	def test_compressed(self):
+		"""
+		The body compressed before caching is not used once the
+		middleware has changed the body.
+		"""
+		for user in ('alice', 'bob'):
+			response = self.get('/compressed?u=' + user, **{'Accept-Encoding': 'gzip'})
+			self.assertEquals(response.content_encoding, 'gzip')
+			response.decode_content()
+			self.assertTrue(('hello %s' % user).encode('utf-8') in response.body)
+		self.assertEquals(len(calls), 1)
+
+class StreamView(GiottoView):
+	@renders('text/html')
+	def html(self, result):
+		return ("<p>%s</p>" % i for i in range(result))
+
+class StreamTest(unittest.TestCase):
+
+	def setUp(self):
+		initialize()
+		del calls[:]
+		self.cache = LocMemKeyValue()
+		giotto._config.cache_engine = self.cache
+		stream = lambda x: counted(x) and int(x)
+		self.app = make_app(Manifest({
+			'stream': Program(model=[stream], view=StreamView()),
+			'cached': Program(model=[stream], view=StreamView(), cache=10),
+		}))
+
+	def test_stream(self):
+		response = Request.blank('/stream/3').get_response(self.app)
+		self.assertEquals(response.status_int, 200)
+		self.assertEquals(response.content_length, None)
+		self.assertEquals(response.body, b'<p>0</p><p>1</p><p>2</p>')
+
+	def test_app_iter(self):
+		environ = Request.blank('/stream/2').environ
+		app_iter = self.app(environ, lambda status, headers: None)
+		self.assertEquals(next(iter(app_iter)), b'<p>0</p>')
+
+	def test_cached_stream(self):
+		"""
+		A streamed response is cached after it has been sent in full.
+		"""
+		first = Request.blank('/cached/3').get_response(self.app)
+		self.assertEquals(first.body, b'<p>0</p><p>1</p><p>2</p>')
+		second = Request.blank('/cached/3').get_response(self.app)
+		self.assertEquals(second.body, first.body)
+		self.assertTrue(second.etag)
+		self.assertEquals(len(calls), 1)
+
+def big_page(x=1):
+	counted(x)
+	return "<p>hello</p>" * 200
+
+class CompressTest(unittest.TestCase):
+
+	def setUp(self):
+		initialize()
+		del calls[:]
+		self.cache = LocMemKeyValue()
+		giotto._config.cache_engine = self.cache
+		html = BasicView(html=lambda m: m)
+		self.app = make_app(Manifest({
+			'page': Program(model=[big_page], view=html, output_middleware=[CompressResponse]),
+			'cached': Program(model=[big_page], view=html, output_middleware=[CompressResponse], cache=10),
+			'small': Program(model=[lambda: "<p>hi</p>"], view=html, output_middleware=[CompressResponse]),
+			'stream': Program(model=[lambda x: int(x)], view=StreamView(), output_middleware=[CompressResponse]),
+			'plain': Program(model=[big_page], view=html),
+		}))
+
+	def get(self, path, app=None, **headers):
+		headers.setdefault('Accept-Encoding', 'gzip, deflate')
+		return Request.blank(path, headers=headers).get_response(app or self.app)
+
+	def test_compressed(self):
+		response = self.get('/page')
+		self.assertEquals(response.content_encoding, 'gzip')
+		self.assertEquals(response.headers['Vary'], 'Accept-Encoding')
+		self.assertTrue(response.content_length < 2400)
+		response.decode_content()
+		self.assertEquals(response.body, b"<p>hello</p>" * 200)
+
+	def test_not_accepted(self):
+		response = self.get('/page', **{'Accept-Encoding': 'identity'})
+		self.assertEquals(response.content_encoding, None)
+		self.assertEquals(response.headers['Vary'], 'Accept-Encoding')
+
+	def test_small(self):
+		self.assertEquals(self.get('/small').content_encoding, None)
+
+	def test_stream(self):
+		response = self.get('/stream/300')
+		self.assertEquals(response.content_encoding, 'gzip')
+		response.decode_content()
+		self.assertEquals(response.body, b''.join(b"<p>%d</p>" % i for i in range(300)))
+
+	def test_cached_compressed_once(self):
+		first = self.get('/cached')
+		entry = [obj for obj, expires, size in self.cache.data.values() if 'response' in obj][0]
+		self.assertEquals(entry['response']['compressed']['gzip'], first.body)
+		second = self.get('/cached')
+		self.assertEquals(second.body, first.body)
+		self.assertEquals(second.content_encoding, 'gzip')
+		self.assertEquals(len(calls), 1)
+
+	def test_not_modified(self):
+		first = self.get('/page')
+		second = self.get('/page', **{'If-None-Match': first.headers['ETag']})
+		self.assertEquals(second.status_int, 304)
+
+	def test_wsgi_middleware(self):
+		app = compress_middleware(self.app)
+		first = self.get('/plain', app=app)
+		self.assertEquals(first.content_encoding, 'gzip')
+		second = self.get('/plain', app=app, **{'If-None-Match': first.headers['ETag']})
+		self.assertEquals(second.status_int, 304)
+		self.assertEquals(second.headers['ETag'], first.headers['ETag'])
+		self.assertEquals(second.headers['Vary'], 'Accept-Encoding')
+
+	def test_wsgi_middleware_other_encoding(self):
+		"""
+		A client that sends the etag of the gzipped body, but doesn't accept
+		gzip, gets the full uncompressed body.
+		"""
+		app = compress_middleware(self.app)
+		first = self.get('/plain', app=app)
+		headers = {'If-None-Match': first.headers['ETag'], 'Accept-Encoding': 'identity'}
+		second = self.get('/plain', app=app, **headers)
+		self.assertEquals(second.status_int, 200)
+		self.assertEquals(second.content_encoding, None)
+		self.assertEquals(second.body, b"<p>hello</p>" * 200)
+
+class StaticTest(unittest.TestCase):
+
+	def setUp(self):
+		initialize()
+		self.project_path = tempfile.mkdtemp()
+		os.makedirs(os.path.join(self.project_path, 'views', 'static'))
+		with open(os.path.join(self.project_path, 'views', 'static', 'file.txt'), 'wb') as f:
+			f.write(b'0123456789' * 10000)
+		giotto._config.project_path = self.project_path
+		self.app = make_app(Manifest({'static': StaticServe()}))
+
+	def tearDown(self):
+		shutil.rmtree(self.project_path)
+
+	def test_full_file(self):
+		response = Request.blank('/static/file.txt').get_response(self.app)
+		self.assertEquals(response.status_int, 200)
+		self.assertEquals(response.content_type, 'text/plain')
+		self.assertEquals(response.content_length, 100000)
+		self.assertEquals(response.body, b'0123456789' * 10000)
+
+	def test_range(self):
+		request = Request.blank('/static/file.txt', headers={'Range': 'bytes=5-14'})
+		response = request.get_response(self.app)
+		self.assertEquals(response.status_int, 206)
+		self.assertEquals(response.body, b'5678901234')
+
+	def test_not_modified(self):
+		first = Request.blank('/static/file.txt').get_response(self.app)
+		request = Request.blank('/static/file.txt', headers={'If-None-Match': first.headers['ETag']})
+		self.assertEquals(request.get_response(self.app).status_int, 304)
+
+	def test_file_wrapper(self):
+		wrapped = []
+		def file_wrapper(file, block_size):
+			wrapped.append(file)
+			return iter([file.read()])
+		request = Request.blank('/static/file.txt', environ={'wsgi.file_wrapper': file_wrapper})
+		response = request.get_response(self.app)
+		self.assertEquals(len(wrapped), 1)
+		self.assertEquals(len(response.body), 100000)
+
+	def test_build_static(self):
+		manifest = build_static()
+		hashed = manifest['file.txt']
+		self.assertNotEquals(hashed, 'file.txt')
+		self.assertEquals(static_url('file.txt'), '/static/' + hashed)
+		static = os.path.join(self.project_path, 'views', 'static')
+		self.assertTrue(os.path.exists(os.path.join(static, hashed + '.gz')))
+		# building again does not fingerprint the fingerprinted files
+		self.assertEquals(build_static(), manifest)
+
+	def test_precompressed(self):
+		build_static()
+		request = Request.blank('/static/file.txt', headers={'Accept-Encoding': 'gzip, deflate'})
+		response = request.get_response(self.app)
+		self.assertEquals(response.content_encoding, 'gzip')
+		self.assertEquals(response.headers['Vary'], 'Accept-Encoding')
+		self.assertEquals(response.content_type, 'text/plain')
+		self.assertTrue(response.content_length < 100000)
+		response.decode_content()
+		self.assertEquals(response.body, b'0123456789' * 10000)
+
+		plain = Request.blank('/static/file.txt').get_response(self.app)
+		self.assertEquals(plain.content_encoding, None)
+		self.assertEquals(plain.content_length, 100000)
+
+	def test_precompressed_stale(self):
+		"""
+		The compressed versions are not served once the file is changed,
+		and are removed by the next build when they don't help anymore.
+		"""
+		build_static()
+		path = os.path.join(self.project_path, 'views', 'static', 'file.txt')
+		with open(path, 'wb') as f:
+			f.write(b'changed')
+		os.utime(path, (time.time() + 10, time.time() + 10))
+
+		request = Request.blank('/static/file.txt', headers={'Accept-Encoding': 'gzip, deflate'})
+		response = request.get_response(self.app)
+		self.assertEquals(response.content_encoding, None)
+		self.assertEquals(response.body, b'changed')
+
+		build_static()
+		self.assertFalse(os.path.exists(path + '.gz'))
+
+	def test_immutable(self):
+		hashed = build_static()['file.txt']
+		response = Request.blank('/static/' + hashed).get_response(self.app)
+		self.assertTrue('immutable' in response.headers['Cache-Control'])
+		response = Request.blank('/static/file.txt').get_response(self.app)
+		self.assertFalse('Cache-Control' in response.headers)
@@ -0,0 +1,48 @@
+import unittest
+
+from giotto.controllers.irc_outbound import OutboundScheduler, split_line
+
+class OutboundSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.scheduler = OutboundScheduler(
+            lambda target, text: self.sent.append((target, text)),
+            rate=1, burst=3, target_rate=1, target_burst=10,
+        )
+
+    def test_merge_short_lines(self):
+        self.scheduler.add('#chan', "\n".join("line %s" % i for i in range(5)))
+        self.scheduler.tick()
+        self.assertEquals(self.sent, [('#chan', "line 0 | line 1 | line 2 | line 3 | line 4")])
+
+    def test_byte_limit(self):
+        self.scheduler.add('#chan', "x" * 1000)
+        self.scheduler.tick()
+        limit = self.scheduler.get_limit('#chan')
+        self.assertEquals([len(text) for target, text in self.sent], [limit, limit, 1000 - 2 * limit])
+
+    def test_flood_control(self):
+        self.scheduler.merge_length = 0 # no merging
+        self.scheduler.add('#chan', "\n".join("line %s" % i for i in range(10)))
+        self.scheduler.tick()
+        self.scheduler.tick()
+        self.assertEquals(len(self.sent), 3)
+        self.assertEquals(self.scheduler.pending(), 7)
+
+    def test_short_replies_first(self):
+        self.scheduler.merge_length = 0
+        self.scheduler.add('#dump', "\n".join("line %s" % i for i in range(10)))
+        self.scheduler.add('#chan', "hi")
+        self.scheduler.tick()
+        self.assertEquals(self.sent[0], ('#chan', "hi"))
+
+    def test_empty_message(self):
+        self.scheduler.add('#chan', " \n\r\n")
+        self.assertEquals(self.scheduler.queues, {})
+
+    def test_split_line(self):
+        self.assertEquals(split_line(u'\xe9\xe9\xe9', 4), [u'\xe9\xe9', u'\xe9'])
+
+if __name__ == '__main__':
+    unittest.main()
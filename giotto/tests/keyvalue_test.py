@@ -0,0 +1,378 @@
+import os
+import unittest
+import threading
+import time
+
+from giotto import keyvalue
+from giotto.keyvalue import (GiottoKeyValue, LocMemKeyValue, TieredKeyValue,
+    single_flight, get_codec, PickleCodec, JSONCodec, CircuitBreaker)
+from giotto.utils import switchout_keyvalue
+
+class LocMemTest(unittest.TestCase):
+
+    def test_get_set(self):
+        kv = LocMemKeyValue()
+        kv.set('key', 'value', 10)
+        self.assertEquals(kv.get('key'), 'value')
+        self.assertEquals(kv.get('missing'), None)
+        self.assertEquals(kv.stats()['hits'], 1)
+        self.assertEquals(kv.stats()['misses'], 1)
+
+    def test_expire(self):
+        now = [100]
+        old = keyvalue.monotonic
+        keyvalue.monotonic = lambda: now[0]
+        try:
+            kv = LocMemKeyValue()
+            kv.set('short', 1, 5)
+            kv.set('long', 2, 50)
+            kv.set('forever', 3, 0)
+            now[0] = 110
+            # expired keys are purged even when they are never read.
+            self.assertEquals(kv.get('long'), 2)
+            self.assertFalse('short' in kv.data)
+            now[0] = 1000
+            self.assertEquals(kv.get('long'), None)
+            self.assertEquals(kv.get('forever'), 3)
+            self.assertEquals(kv.stats()['expirations'], 2)
+        finally:
+            keyvalue.monotonic = old
+
+    def test_lru_eviction(self):
+        kv = LocMemKeyValue(max_entries=2)
+        kv.set('a', 1, 10)
+        kv.set('b', 2, 10)
+        kv.get('a')
+        kv.set('c', 3, 10)
+        self.assertEquals(kv.get('b'), None)
+        self.assertEquals(kv.get('a'), 1)
+        self.assertEquals(kv.stats()['evictions'], 1)
+
+    def test_byte_limit(self):
+        kv = LocMemKeyValue(max_bytes=10000)
+        for i in range(100):
+            kv.set(i, 'x' * 1000, 10)
+        self.assertTrue(kv.stats()['bytes'] <= 10000)
+        self.assertEquals(kv.get(99), 'x' * 1000)
+
+class DictKeyValue(GiottoKeyValue):
+    """
+    Custom backend that only implements the single key API.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, obj, expire):
+        self.data[key] = obj
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+class ManyTest(unittest.TestCase):
+
+    def test_many(self):
+        for kv in [LocMemKeyValue(), DictKeyValue(), TieredKeyValue(LocMemKeyValue())]:
+            kv.set_many({'a': 1, 'b': 2, 'c': 3}, 10)
+            self.assertEquals(kv.get_many(['a', 'b', 'x']), {'a': 1, 'b': 2})
+            kv.delete_many(['a', 'b'])
+            kv.delete('c')
+            self.assertEquals(kv.get_many(['a', 'b', 'c']), {})
+
+class CodecTest(unittest.TestCase):
+    value = {'body': 'x' * 5000, 'mimetype': 'text/html', 'persist': None}
+
+    def test_round_trip(self):
+        for codec in [PickleCodec(), JSONCodec(), get_codec('json+zlib'), get_codec('pickle+zlib')]:
+            self.assertEquals(codec.loads(codec.dumps(self.value)), self.value)
+
+    def test_json_bytes(self):
+        """
+        Cached responses can hold bytes, such as streamed or compressed bodies.
+        """
+        value = {'body': b'\x1f\x8b\x00', 'compressed': {'gzip': b'\xff'}, 'etag': 'abc'}
+        codec = JSONCodec()
+        self.assertEquals(codec.loads(codec.dumps(value)), value)
+
+    def test_unserializable(self):
+        """
+        A value the codec can't serialize is not stored, instead of raising.
+        """
+        kv = GiottoKeyValue()
+        kv.codec = JSONCodec()
+        self.assertEquals(kv.encode({'value': object()}), None)
+        self.assertEquals(list(kv.encode_many({'a': 1, 'b': object()}).keys()), ['a'])
+
+    def test_unknown_flag(self):
+        """
+        Values not written by a codec are rejected, instead of having their
+        first byte dropped.
+        """
+        self.assertRaises(ValueError, PickleCodec().loads, b'{"a": 1}')
+
+    def test_undecodable(self):
+        """
+        Values written with another codec, or corrupted, are misses.
+        """
+        kv = GiottoKeyValue()
+        kv.codec = JSONCodec()
+        pickled = PickleCodec().dumps(self.value)
+        corrupt = b'z' + b'not zlib data'
+        self.assertEquals(kv.decode(pickled), None)
+        self.assertEquals(kv.decode(corrupt), None)
+        found = kv.decode_many({'a': kv.codec.dumps(1), 'b': pickled, 'c': corrupt})
+        self.assertEquals(found, {'a': 1})
+
+    def test_compression_threshold(self):
+        codec = JSONCodec(compression='zlib', threshold=10000)
+        self.assertTrue(len(codec.dumps(self.value)) > 5000)
+        codec = JSONCodec(compression='zlib', threshold=100)
+        self.assertTrue(len(codec.dumps(self.value)) < 500)
+
+class FakeRedis(object):
+    """
+    Stands in for the redis module. Pub/sub connections with a socket
+    timeout raise TimeoutError when nothing is published in time, like redis-py.
+    """
+    class RedisError(Exception):
+        pass
+
+    class TimeoutError(RedisError):
+        pass
+
+    def __init__(self):
+        self.pubsubs = []
+
+    def ConnectionPool(self, **kwargs):
+        pool = FakeRedis()
+        pool.connection_kwargs = kwargs
+        return pool
+
+    def StrictRedis(self, connection_pool):
+        client = FakeRedis()
+        client.pubsub = lambda: self.make_pubsub(connection_pool)
+        return client
+
+    def make_pubsub(self, pool):
+        pubsub = FakePubSub(pool.connection_kwargs.get('socket_timeout'), self.TimeoutError)
+        self.pubsubs.append(pubsub)
+        return pubsub
+
+class FakePubSub(object):
+    def __init__(self, timeout, timeout_error, messages=()):
+        self.timeout = timeout
+        self.timeout_error = timeout_error
+        self.messages = messages
+        self.closed = threading.Event()
+
+    def subscribe(self, channel):
+        pass
+
+    def listen(self):
+        for message in self.messages:
+            yield message
+        if not self.closed.wait(self.timeout):
+            raise self.timeout_error()
+
+    def close(self):
+        self.closed.set()
+
+class TieredTest(unittest.TestCase):
+
+    def test_local_hit(self):
+        remote = LocMemKeyValue()
+        kv = TieredKeyValue(remote)
+        kv.set('key', 'value', 10)
+        remote.delete('key')
+        self.assertEquals(kv.get('key'), 'value')
+
+    def test_version_invalidation(self):
+        """
+        A set from another process clears the local cache.
+        """
+        remote = LocMemKeyValue()
+        kv1 = TieredKeyValue(remote, version_check_interval=0)
+        kv2 = TieredKeyValue(remote, version_check_interval=0)
+        kv1.set('key', 'one', 10)
+        self.assertEquals(kv2.get('key'), 'one')
+        kv1.set('key', 'two', 10)
+        self.assertEquals(kv2.get('key'), 'two')
+
+    def test_batch_invalidation(self):
+        """
+        set_many and delete_many bump the version once, not once per key.
+        """
+        remote = LocMemKeyValue()
+        versions = []
+        set_ = remote.set
+        def set(key, obj, expire):
+            if key == TieredKeyValue.version_key:
+                versions.append(obj)
+            set_(key, obj, expire)
+        remote.set = set
+
+        kv1 = TieredKeyValue(remote, version_check_interval=0)
+        kv2 = TieredKeyValue(remote, version_check_interval=0)
+        kv1.set_many({'a': 1, 'b': 2, 'c': 3}, 10)
+        self.assertEquals(len(versions), 1)
+        self.assertEquals(kv2.get_many(['a', 'b']), {'a': 1, 'b': 2})
+        kv1.delete_many(['a', 'b', 'c'])
+        self.assertEquals(len(versions), 2)
+        self.assertEquals(kv2.get_many(['a', 'b']), {})
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_listener_after_fork(self):
+        """
+        A forked process starts its own pub/sub listener thread, with its own
+        id, and doesn't keep the L1 of its parent.
+        """
+        kv = TieredKeyValue(LocMemKeyValue())
+        # pretend the backend is redis
+        kv.pubsub, kv.listener_pid, kv.listener_lock = True, None, threading.Lock()
+        read, write = os.pipe()
+        listening = threading.Event()
+        def listen():
+            os.write(write, ("%s %s\n" % (os.getpid(), kv.id)).encode('ascii'))
+            listening.set()
+        kv.listen = listen
+
+        kv.local.set('key', 'value', 10)
+        self.assertEquals(kv.get('key'), 'value')
+        listening.wait(5)
+        listening.clear()
+        parent_id = kv.id
+        pid = os.fork()
+        if not pid:
+            missing = kv.get('key') is None
+            os._exit(0 if listening.wait(5) and missing else 1)
+        status = os.waitpid(pid, 0)[1]
+        self.assertEquals(status, 0)
+
+        with os.fdopen(read) as f:
+            os.close(write)
+            started = [line.split() for line in f.read().splitlines()]
+        self.assertEquals(started, [[str(os.getpid()), parent_id], [str(pid), started[1][1]]])
+        self.assertNotEquals(started[1][1], parent_id)
+
+    def test_idle_listener(self):
+        """
+        The pub/sub listener waits on a connection without a socket timeout,
+        so an idle channel doesn't clear the L1.
+        """
+        fake, real = FakeRedis(), keyvalue.redis
+        keyvalue.redis = fake
+        try:
+            kv = TieredKeyValue(keyvalue.RedisKeyValue(socket_timeout=0.01))
+            kv.local.set('key', 'value', 10)
+            self.assertEquals(kv.get('key'), 'value')
+            time.sleep(0.1)
+            self.assertEquals(kv.local.get('key'), 'value')
+            self.assertEquals([pubsub.timeout for pubsub in fake.pubsubs], [None])
+        finally:
+            keyvalue.redis = real
+
+    def test_listener_closes_pubsub(self):
+        """
+        After a connection error, the old pub/sub connection is closed
+        before subscribing again.
+        """
+        fake, real = FakeRedis(), keyvalue.redis
+        keyvalue.redis = fake
+        try:
+            # the first connection fails, the next one waits for messages
+            timeouts = [0.01, None]
+            def make_pubsub(pool):
+                fake.pubsubs.append(FakePubSub(timeouts.pop(0), fake.TimeoutError))
+                return fake.pubsubs[-1]
+            fake.make_pubsub = make_pubsub
+            TieredKeyValue(keyvalue.RedisKeyValue()).start_listener()
+            deadline = time.time() + 5
+            while len(fake.pubsubs) < 2 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(fake.pubsubs[0].closed.is_set())
+            self.assertFalse(fake.pubsubs[1].closed.is_set())
+        finally:
+            keyvalue.redis = real
+
+    def test_listener_many_keys(self):
+        """
+        One message drops all the keys a set_many from another process changed.
+        """
+        fake, real = FakeRedis(), keyvalue.redis
+        keyvalue.redis = fake
+        try:
+            message = {'type': 'message', 'data': b'other:a\nb'}
+            fake.make_pubsub = lambda pool: FakePubSub(None, fake.TimeoutError, [message])
+            kv = TieredKeyValue(keyvalue.RedisKeyValue())
+            kv.local.set_many({'a': 1, 'b': 2, 'c': 3}, 10)
+            kv.start_listener()
+            deadline = time.time() + 5
+            while kv.local.get('a') is not None and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEquals(kv.local.get_many(['a', 'b', 'c']), {'c': 3})
+        finally:
+            keyvalue.redis = real
+
+    def test_switchout(self):
+        kv = switchout_keyvalue('tiered-locmem')(host='localhost')
+        self.assertTrue(isinstance(kv.backend, LocMemKeyValue))
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_open_after_failures(self):
+        calls = []
+        def down():
+            calls.append(1)
+            raise IOError("connection refused")
+
+        breaker = CircuitBreaker(IOError, threshold=2, retry_after=30)
+        for x in range(5):
+            self.assertEquals(breaker.call('miss', down), 'miss')
+        self.assertEquals(len(calls), 2)
+        self.assertTrue(breaker.is_open())
+
+    def test_recover(self):
+        breaker = CircuitBreaker(IOError, threshold=1, retry_after=0)
+        breaker.call(None, lambda: open('/does/not/exist'))
+        self.assertEquals(breaker.call(None, lambda: 'up'), 'up')
+        self.assertEquals(breaker.failures, 0)
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_coalesce_threads(self):
+        """
+        Concurrent misses for the same key only compute the value once.
+        """
+        kv = LocMemKeyValue()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            kv.set('key', 'value', 10)
+            return 'value'
+
+        def request():
+            results.append(single_flight(kv, 'key', compute))
+
+        threads = [threading.Thread(target=request) for x in range(5)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(results, ['value'] * 5)
+
+    def test_cross_process_lock(self):
+        """
+        When another process holds the lock, wait for its value to show up.
+        """
+        kv = LocMemKeyValue()
+        kv.acquire_lock = lambda key, expire: False
+        timer = threading.Timer(0.1, lambda: kv.set('key', 'theirs', 10))
+        timer.start()
+        self.assertEquals(single_flight(kv, 'key', lambda: 'mine'), 'theirs')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -134,6 +134,47 @@ class StackedRootTest(unittest.TestCase):
             }
             self.assertEquals(parsed, correct)
 
+    def test_parse_invocation_invalidated(self):
+        """
+        Changing a nested manifest after the routes have been compiled
+        makes the new program reachable.
+        """
+        self.manifest.parse_invocation('/sub/prog', 'http-get')
+        added = Program(name='added')
+        self.manifest['sub']['another']['added'] = added
+        parsed = self.manifest.parse_invocation('/sub/another/added/x', 'http-get')
+        self.assertEquals(parsed['program'], added)
+        self.assertEquals(parsed['args'], ['x'])
+
+        del self.manifest['sub']['another']['added']
+        parsed = self.manifest.parse_invocation('/sub/another/added/x', 'http-get')
+        self.assertEquals(parsed['program'], blank)
+        self.assertEquals(parsed['args'], ['added', 'x'])
+
+    def test_parse_invocation_top_root_arg(self):
+        """
+        Args that fall through to the top level root program keep their
+        first segment.
+        """
+        parsed = self.manifest.parse_invocation('/redirectfoo/x', 'http-get')
+        self.assertEquals(parsed['program'].name, 'root')
+        self.assertEquals(parsed['args'], ['redirectfoo', 'x'])
+        self.assertEquals(parsed['raw_args'], 'redirectfoo/x')
+
+    def test_is_root_path(self):
+        self.assertTrue(self.manifest.is_root_path('/'))
+        self.assertTrue(self.manifest.is_root_path('/sub/another'))
+        self.assertFalse(self.manifest.is_root_path('/sub/prog'))
+
+    def test_find_program_path(self):
+        """
+        The routing trie finds the same longest prefix as scanning every url.
+        """
+        for invocation in ['/', '/deep.json', '/sub/another/both.html/a', '/sub/double/x/y', '/nope/x']:
+            urls = self.manifest.get_urls(controllers=['http-get'])
+            longest = max([u for u in urls if invocation.startswith(u)], key=len)
+            self.assertEquals(self.manifest.find_program_path(invocation, 'http-get'), longest)
+
     def xtest_parse_invocation_invalid(self):
         #print self.manifest.parse_invocation('/sub/double', 'irc')
         #print self.manifest.get_urls('irc')
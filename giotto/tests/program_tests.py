@@ -7,6 +7,7 @@ except ImportError:
 from giotto.programs import Program
 from giotto.views import BasicView
 from giotto.exceptions import MockNotFound
+from giotto.primitives import LOGGED_IN_USER, RAW_INVOCATION_ARGS
 
 def simple(x, y):
     return None
@@ -63,5 +64,16 @@ class ArgspecTest(unittest.TestCase):
         a, kw = program.get_model_args_kwargs()
         self.assertEquals(list(kw.keys()), ['a', 'b', 'c', 'd'])
 
+    def test_model_binding(self):
+        def test(a, b=LOGGED_IN_USER, c=RAW_INVOCATION_ARGS, d=None): pass
+        binding = Program(model=[test], view=BasicView()).model_binding
+        self.assertEquals(binding.args, ('a',))
+        self.assertEquals([f[0] for f in binding.fields], ['a', 'b', 'c', 'd'])
+        self.assertEquals(binding.fields[0][1], NotImplemented)
+        self.assertEquals(binding.fields[1][2], LOGGED_IN_USER)
+        self.assertEquals(binding.fields[3][1:], (None, None, False))
+        self.assertTrue(binding.fields[2][3])
+        self.assertTrue(binding.takes_raw)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
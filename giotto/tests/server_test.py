@@ -0,0 +1,86 @@
+import os
+import signal
+import socket
+import time
+import unittest
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from giotto.server import PreforkServer, get_memory_usage
+
+def pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode('ascii')]
+
+@unittest.skipUnless(os.path.exists('/proc/self/statm'), "needs /proc")
+class MemoryUsageTest(unittest.TestCase):
+
+    def test_current(self):
+        """
+        The memory in use now is measured, not the peak.
+        """
+        before = get_memory_usage()
+        data = bytearray(100 * 1024 * 1024)
+        self.assertTrue(get_memory_usage() > before + 50)
+        del data
+        self.assertTrue(get_memory_usage() < before + 50)
+
+@unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+class PreforkServerTest(unittest.TestCase):
+
+    def setUp(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+
+        self.master = os.fork()
+        if not self.master:
+            try:
+                PreforkServer('127.0.0.1', self.port, pid_app, workers=2, threads=2, max_requests=3, timeout=1).run()
+            finally:
+                os._exit(0)
+
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+
+    def tearDown(self):
+        os.kill(self.master, signal.SIGTERM)
+        os.waitpid(self.master, 0)
+
+    def get(self):
+        return urlopen('http://127.0.0.1:%s/' % self.port, timeout=5).read()
+
+    def test_workers_restart(self):
+        """
+        Workers are replaced after `max_requests` requests, and no request
+        gets lost while that happens.
+        """
+        pids = set(self.get() for i in range(20))
+        self.assertTrue(len(pids) > 2)
+        self.assertFalse(str(self.master).encode('ascii') in pids)
+
+    def test_idle_connections(self):
+        """
+        Connections that never send a request are closed after the timeout,
+        they don't keep the threads of every worker busy.
+        """
+        idle = [socket.create_connection(('127.0.0.1', self.port)) for i in range(4)]
+        try:
+            self.assertTrue(self.get())
+            idle[0].settimeout(5)
+            self.assertEqual(idle[0].recv(1), b'')
+        finally:
+            for sock in idle:
+                sock.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import threading
+import time
+import unittest
+
+from giotto.utils import KeyedWorkerPool, TokenBucket, decode_chunks
+
+class KeyedWorkerPoolTest(unittest.TestCase):
+
+    def test_order_per_key(self):
+        pool = KeyedWorkerPool(workers=4, max_queue=100)
+        ran = {'a': [], 'b': []}
+        done = threading.Semaphore(0)
+        def job(key, i):
+            time.sleep(0.001)
+            ran[key].append(i)
+            done.release()
+
+        for i in range(20):
+            pool.submit('a', job, 'a', i)
+            pool.submit('b', job, 'b', i)
+        for i in range(40):
+            done.acquire()
+        pool.stop()
+        self.assertEquals(ran['a'], list(range(20)))
+        self.assertEquals(ran['b'], list(range(20)))
+
+    def test_queue_limit(self):
+        pool = KeyedWorkerPool(workers=1, max_queue=2)
+        release = threading.Event()
+        started = threading.Event()
+        def blocked():
+            started.set()
+            release.wait()
+
+        self.assertTrue(pool.submit('a', blocked))
+        started.wait()
+        self.assertTrue(pool.submit('a', blocked))
+        self.assertTrue(pool.submit('b', blocked))
+        self.assertFalse(pool.submit('c', blocked))
+        release.set()
+        pool.stop()
+
+class DecodeChunksTest(unittest.TestCase):
+
+    def test_split_character(self):
+        encoded = u"caf\xe9".encode('utf-8')
+        chunks = [encoded[:4], encoded[4:], u"!"]
+        self.assertEqual(u''.join(decode_chunks(iter(chunks))), u"caf\xe9!")
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=1, capacity=3)
+        self.assertEquals([bucket.take() for i in range(4)], [True, True, True, False])
+        self.assertTrue(0 < bucket.wait_time() <= 1)
+
+if __name__ == '__main__':
+    unittest.main()
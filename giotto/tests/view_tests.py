@@ -1,7 +1,15 @@
 import unittest
+import os
+import shutil
+import tempfile
+
+import giotto
+from giotto import initialize
 from giotto.exceptions import NoViewMethod
-from giotto.views import GiottoView, BasicView, renders
+from giotto.views import (GiottoView, BasicView, renders, jinja_template,
+    partial_jinja_template, get_jinja_template, get_jinja_environment)
 from giotto.control import Redirection
+from giotto.utils import is_stream
 
 class Blog(object):
     def __init__(self, id=None, title=None, body=None):
@@ -71,6 +79,21 @@ class RendererTests(unittest.TestCase):
             result = view.render({}, 'text/html')
             self.assertEquals(result['body'], "inherited")
 
+    def test_negotiation_cache(self):
+        """
+        Each accept header is only negotiated once, and the cache does not
+        grow past its size limit.
+        """
+        view = BasicView()
+        view.negotiated.maxsize = 2
+        first = view.get_renderer('text/html')
+        self.assertTrue(view.get_renderer(' TEXT/HTML') is first)
+        self.assertEquals(first.num_args, 2)
+        self.assertEquals(first.mimetype, 'text/html')
+        view.get_renderer('application/json')
+        view.get_renderer('text/plain')
+        self.assertEquals(len(view.negotiated), 2)
+
 class TestGenericView(unittest.TestCase):
     def test_list_html(self):
         result = BasicView().render(['one', 'two'], 'text/html')['body']
@@ -113,5 +136,49 @@ class TestGenericView(unittest.TestCase):
         assert "None" in result
 
 
+class JinjaTemplateTest(unittest.TestCase):
+    def setUp(self):
+        initialize()
+        self.project_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.project_path, 'views'))
+        with open(os.path.join(self.project_path, 'views', 'test.html'), 'w') as f:
+            f.write("{{ data }} {{ other }}")
+        giotto._config.project_path = self.project_path
+
+    def tearDown(self):
+        shutil.rmtree(self.project_path)
+
+    def test_template_is_cached(self):
+        self.assertTrue(get_jinja_template('test.html') is get_jinja_template('test.html'))
+
+    def test_settings_change(self):
+        """
+        Calling initialize with different jinja settings takes effect.
+        """
+        env = get_jinja_environment()
+        self.assertEquals(env.cache.capacity, 400)
+        initialize()
+        giotto._config.jinja_cache_size = 10
+        giotto._config.debug = True
+        env = get_jinja_environment()
+        self.assertEquals(env.cache.capacity, 10)
+        self.assertTrue(env.auto_reload)
+
+    def test_partial_does_not_leak(self):
+        """
+        Partial renders use their own environment, so full renders of the same
+        template still drop undefined variables.
+        """
+        partial = partial_jinja_template('test.html')('x', None)['body']
+        full = jinja_template('test.html')('x', None)['body']
+        self.assertEquals(partial, "x {{ other }}")
+        self.assertEquals(full, "x ")
+
+    def test_stream(self):
+        body = jinja_template('test.html', stream=True)('x', None)['body']
+        self.assertTrue(is_stream(body))
+        self.assertEquals(''.join(body), "x ")
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,13 +1,44 @@
 import string
 import random
+import functools
+import hashlib
 import json
 import traceback
 import re
 import unicodedata
+import threading
+import gzip
+import zlib
+import codecs
 import six
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    from inspect import getargspec # python2
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic # python2
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue # python2
 
 from giotto import get_config
-from collections import defaultdict
+from collections import defaultdict, deque
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict # python2.6
 
 def switchout_keyvalue(engine):
     from giotto import keyvalue
@@ -21,6 +52,10 @@ def switchout_keyvalue(engine):
         return keyvalue.MemcacheKeyValue
     if engine == 'redis':
         return keyvalue.RedisKeyValue
+    if engine.startswith('tiered-'):
+        # in-process cache in front of another backend, eg: 'tiered-redis'
+        backend = engine[len('tiered-'):]
+        return functools.partial(keyvalue.TieredKeyValue, backend)
 
 class Mock(object):
     """
@@ -48,6 +83,141 @@ class Mock(object):
     def __iter__(self):
         return iter([])
 
+class LRUCache(object):
+    """
+    A thread safe dictionary that holds at most `maxsize` items. When full,
+    the least recently used item gets thrown out.
+    >>> c = LRUCache(2)
+    >>> c.set('a', 1); c.set('b', 2); c.get('a'); c.set('c', 3)
+    1
+    >>> c.get('b') is None
+    True
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return default
+            self.data[key] = value # move to the most recently used end
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+class TokenBucket(object):
+    """
+    Allows `rate` events per second on average, with bursts of up to
+    `capacity` events.
+    >>> bucket = TokenBucket(rate=1, capacity=2)
+    >>> bucket.take(), bucket.take(), bucket.take()
+    (True, True, False)
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, tokens=1):
+        """
+        Use up `tokens` tokens if there are enough of them. Returns False if not.
+        """
+        self.refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def wait_time(self, tokens=1):
+        """
+        How many seconds until `tokens` tokens are available.
+        """
+        self.refill()
+        return max(0, (tokens - self.tokens) / self.rate)
+
+class KeyedWorkerPool(object):
+    """
+    Runs jobs in a pool of `workers` threads. Jobs submitted with the same
+    key are run one at a time, in the order they were submitted. Jobs with
+    different keys run concurrently. At most `max_queue` jobs can be waiting
+    to run, `submit` returns False when the queue is full.
+    """
+    def __init__(self, workers=4, max_queue=100):
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.pending = {} # key -> deque of jobs for that key
+        self.ready = queue.Queue() # keys that have jobs and no worker
+        self.depth = 0
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, func, *args):
+        with self.lock:
+            if self.depth >= self.max_queue:
+                return False
+            self.depth += 1
+            if key in self.pending:
+                # a worker already has (or will get) this key.
+                self.pending[key].append((func, args))
+            else:
+                self.pending[key] = deque([(func, args)])
+                self.ready.put(key)
+        return True
+
+    def work(self):
+        while True:
+            key = self.ready.get()
+            if key is None:
+                return
+            with self.lock:
+                func, args = self.pending[key].popleft()
+                self.depth -= 1
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            with self.lock:
+                if self.pending[key]:
+                    # the key's next job goes to the back of the line, so
+                    # one busy key doesn't keep a worker to itself.
+                    self.ready.put(key)
+                else:
+                    del self.pending[key]
+
+    def stop(self):
+        for thread in self.threads:
+            self.ready.put(None)
+
 def parse_kwargs(kwargs):
     """
     Convert a list of kwargs into a dictionary. Duplicates of the same keyword
@@ -92,6 +262,186 @@ def super_accept_to_mimetype(ext):
     if ext == 'xml':
         return 'application/xml'
 
+def canonical_encode(obj):
+    """
+    Encode `obj` into a string that is the same every time for equal values,
+    regardless of dictionary ordering. Objects that are not basic python
+    types are encoded through their `todict` method or their string value.
+    >>> canonical_encode({'b': [1, 'x'], 'a': None})
+    'd{s1:a=N;s1:b=l[i1;s1:x;];}'
+    """
+    if obj is None:
+        return 'N'
+    if obj is True or obj is False:
+        return 'b%d' % obj
+    if isinstance(obj, six.integer_types):
+        return 'i%d' % obj
+    if isinstance(obj, float):
+        return 'f%r' % obj
+    if isinstance(obj, six.binary_type):
+        obj = obj.decode('utf-8', 'replace')
+    if isinstance(obj, six.string_types):
+        return 's%d:%s' % (len(obj), obj)
+    if hasattr(obj, 'items'):
+        items = sorted(
+            "%s=%s" % (canonical_encode(k), canonical_encode(v)) for k, v in obj.items()
+        )
+        return 'd{%s}' % ''.join(i + ';' for i in items)
+    if type(obj) in (list, tuple):
+        return 'l[%s]' % ''.join(canonical_encode(i) + ';' for i in obj)
+    if type(obj) in (set, frozenset):
+        return 'l[%s]' % ''.join(sorted(canonical_encode(i) + ';' for i in obj))
+    if hasattr(obj, 'todict'):
+        return canonical_encode(obj.todict())
+    return canonical_encode(six.text_type(obj))
+
+try:
+    _digest = functools.partial(hashlib.blake2b, digest_size=16)
+except AttributeError:
+    _digest = hashlib.md5 # python2
+
+def make_digest(*values):
+    """
+    Short, fixed length hash of the canonical encoding of `values`.
+    """
+    encoded = canonical_encode(values).encode('utf-8')
+    return _digest(encoded).hexdigest()
+
+def make_etag(body):
+    """
+    Strong etag (without the quotes) for a response body. Returns None for
+    bodies that are not strings, such as files.
+    """
+    if isinstance(body, six.text_type):
+        body = body.encode('utf-8')
+    if not isinstance(body, six.binary_type):
+        return None
+    return _digest(body).hexdigest()
+
+def is_stream(body):
+    """
+    True if `body` is a generator or iterator meant to be streamed to the
+    client piece by piece, as opposed to a string, file or control object.
+    """
+    if hasattr(body, 'read') or isinstance(body, (six.string_types, six.binary_type)):
+        return False
+    return hasattr(body, '__next__') or hasattr(body, 'next')
+
+def encode_chunks(chunks, charset='utf-8'):
+    """
+    Iterate over a streamed body, encoding text chunks to bytes. Closes the
+    stream when done, even if the client disconnects halfway through.
+    """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, six.text_type):
+                chunk = chunk.encode(charset)
+            if chunk:
+                yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def decode_chunks(chunks, charset='utf-8'):
+    """
+    The opposite of `encode_chunks`, for controllers that write text: iterate
+    over a streamed body, decoding byte chunks. A character split across
+    two chunks is decoded once its second half arrives.
+    """
+    decoder = codecs.getincrementaldecoder(charset)('replace')
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, six.binary_type):
+                chunk = decoder.decode(chunk)
+            if chunk:
+                yield chunk
+        rest = decoder.decode(b'', final=True)
+        if rest:
+            yield rest
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def decode_body(body, charset='utf-8'):
+    """
+    A response body as text. Bytes bodies (such as cached streamed bodies)
+    are decoded, streamed bodies are read to the end.
+    """
+    if is_stream(body):
+        return u''.join(decode_chunks(body, charset))
+    if isinstance(body, six.binary_type):
+        return body.decode(charset, 'replace')
+    return body
+
+compressible_mimetypes = set([
+    'application/javascript', 'application/json', 'application/xml',
+    'application/x-javascript', 'image/svg+xml', 'image/x-icon',
+])
+
+# content encodings giotto can make, in order of preference.
+compress_encodings = ['br', 'gzip'] if brotli else ['gzip']
+
+def is_compressible(mimetype):
+    mimetype = (mimetype or '').split(';')[0].strip()
+    return mimetype.startswith('text/') or mimetype in compressible_mimetypes
+
+def compress(content, encoding, level=9):
+    """
+    Compress `content` (bytes) with either 'gzip' or 'br'. `level` goes from
+    0 to 9 for gzip and from 0 to 11 for brotli (higher is capped to 9 for gzip).
+    """
+    if encoding == 'br':
+        return brotli.compress(content, quality=level)
+    buf = BytesIO()
+    # mtime=0 so the same input always compresses to the same bytes
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0, compresslevel=min(level, 9)) as f:
+        f.write(content)
+    return buf.getvalue()
+
+def compress_stream(chunks, encoding, level=5):
+    """
+    Compress a streamed body chunk by chunk. Each chunk is flushed through
+    the compressor right away, so the client doesn't wait for a full buffer.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(min(level, 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield process(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+def choose_encoding(accept_encoding, encodings=compress_encodings):
+    """
+    Out of `encodings`, return the one that the client prefers according
+    to the `accept_encoding` header, or None if the client accepts none of them.
+    >>> choose_encoding('gzip;q=0.5, br', ['gzip'])
+    'gzip'
+    """
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        name, _, params = item.partition(';')
+        params = params.strip()
+        try:
+            accepted[name.strip().lower()] = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            continue
+
+    best = None
+    for encoding in encodings:
+        q = accepted.get(encoding, accepted.get('*', 0))
+        if q > 0 and (not best or q > best[1]):
+            best = (encoding, q)
+    return best and best[0]
+
 def random_string(n):
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(n))
 
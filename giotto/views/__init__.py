@@ -1,16 +1,25 @@
 import os
 import json
+import threading
 import mimeparse
-import inspect
+from collections import namedtuple
 
-from jinja2 import Template, DebugUndefined, Environment, PackageLoader, FileSystemLoader
+from jinja2 import (Template, DebugUndefined, Environment, PackageLoader,
+    FileSystemLoader, FileSystemBytecodeCache)
 from jinja2.exceptions import TemplateNotFound
 
+import giotto
 from giotto import get_config
 from giotto.exceptions import NoViewMethod
-from giotto.utils import Mock, htmlize, htmlize_list, pre_process_json, super_accept_to_mimetype, jsonify
+from giotto.utils import (Mock, htmlize, htmlize_list, pre_process_json,
+    super_accept_to_mimetype, jsonify, getargspec, LRUCache)
 from giotto.control import GiottoControl, Redirection
 
+# The result of content negotiation. `func` is the render function (or control
+# object), `num_args` is how many arguments it takes (1 or 2), `mimetype` is its
+# principle mimetype and `target_mimetype` is the mimetype that was matched.
+Renderer = namedtuple('Renderer', ['func', 'num_args', 'mimetype', 'target_mimetype', 'is_control'])
+
 def renders(*mimetypes):
     def decorator(func):
         func.mimetypes = []
@@ -24,11 +33,14 @@ class GiottoView(object):
     Base class for all Giotto view objects. All Giotto Views must at least descend
     from this class, as ths class contains piping that the controller calls.
     """
+    # maximum number of negotiated Accept headers/superformats to remember
+    negotiation_cache_size = 64
 
     def __init__(self, persist=None, **kwargs):
         self.persist = persist
         self.render_map = {} # renderers by mimetype
         self.reject_map = {} # renderers by name (no corresponding mimetype)
+        self.negotiated = LRUCache(self.negotiation_cache_size)
         class_defined_renderers = [x for x in dir(self) if not x.startswith('__')]
         self._register_renderers(class_defined_renderers)
 
@@ -48,6 +60,7 @@ class GiottoView(object):
         Go through the passed in list of attributes and register those renderers
         in the render map.
         """
+        self.negotiated.clear()
         for method in attrs:
             func = getattr(self, method)
             mimetypes = getattr(func, 'mimetypes', [])
@@ -77,31 +90,79 @@ class GiottoView(object):
                 return True
         return False
 
-    def render(self, result, mimetype, errors=None):
+    def get_renderer(self, mimetype):
         """
-        Render a model result into `mimetype` format.
+        Negotiate which render function will be used for `mimetype` (an accept
+        header or superformat). The result is remembered so that each accept
+        header only gets negotiated once.
         """
+        key = mimetype.strip()
+        if '/' in key:
+            key = key.lower().replace(' ', '')
+
+        renderer = self.negotiated.get(key)
+        if renderer:
+            return renderer
+
         available_mimetypes = [x for x in self.render_map.keys() if '/' in x]
         render_func = None
+        target_mimetype = None
 
-        if '/' not in mimetype:
+        if '/' not in key:
             # naked superformat (does not correspond to a mimetype)
-            render_func = self.reject_map.get(mimetype, None)
+            render_func = self.reject_map.get(key, None)
             if not render_func:
                 raise NoViewMethod("Unknown Superformat: %s" % mimetype)
 
         if not render_func and available_mimetypes:
-            target_mimetype = mimeparse.best_match(available_mimetypes, mimetype)
+            target_mimetype = mimeparse.best_match(available_mimetypes, key)
             render_func = self.render_map.get(target_mimetype, None)
 
         if not render_func:
             raise NoViewMethod("%s not supported for this program" % mimetype)
 
-        principle_mimetype = render_func.mimetypes[0]
-
         if GiottoControl in render_func.__class__.mro():
             # redirection defined as view (not wrapped in lambda)
-            return {'body': render_func, 'persist': render_func.persist}
+            num_args = 0
+            is_control = True
+        else:
+            # render functins can take either one or two arguments, both are
+            # supported by the API
+            arg_names = getargspec(render_func).args
+            num_args = len(set(arg_names) - set(['self', 'cls']))
+            is_control = False
+
+        renderer = Renderer(
+            render_func, num_args, render_func.mimetypes[0], target_mimetype, is_control
+        )
+        self.negotiated.set(key, renderer)
+        return renderer
+
+    def render(self, result, mimetype, errors=None):
+        """
+        Render a model result into `mimetype` format.
+        """
+        renderer = self.get_renderer(mimetype)
+
+        if renderer.is_control:
+            # redirection defined as view (not wrapped in lambda)
+            return {'body': renderer.func, 'persist': renderer.func.persist}
+
+        data = self.call_renderer(renderer, result, errors)
+        return self.finish_render(renderer, result, data)
+
+    def call_renderer(self, renderer, result, errors=None):
+        if renderer.num_args == 2:
+            return renderer.func(result, errors or Mock())
+        # if the renderer only has one argument, don't pass in the 2nd arg.
+        return renderer.func(result)
+
+    def finish_render(self, renderer, result, data):
+        """
+        Turn what the render function returned into a response dict with
+        the body, mimetype and persist data.
+        """
+        target_mimetype = renderer.target_mimetype
 
         if callable(self.persist):
             # persist (cookie data) can be either an object, or a callable)
@@ -109,30 +170,20 @@ class GiottoView(object):
         else:
             persist = self.persist
 
-        # render functins can take either one or two arguments, both are
-        # supported by the API
-        arg_names = inspect.getargspec(render_func).args
-        num_args = len(set(arg_names) - set(['self', 'cls']))
-        if num_args == 2:
-            data = render_func(result, errors or Mock())
-        else:
-            # if the renderer only has one argument, don't pass in the 2nd arg.
-            data = render_func(result)
-
         if GiottoControl in data.__class__.mro():
             # render function returned a control object
             return {'body': data, 'persist': persist}
 
         if not hasattr(data, 'items'):
             # view returned string
-            data = {'body': data, 'mimetype': principle_mimetype}
+            data = {'body': data, 'mimetype': renderer.mimetype}
         else:
             # result is a dict in for form {body: XX, mimetype: xx}
             if not 'mimetype' in data and target_mimetype == '*/*':
                 data['mimetype'] = ''
 
             if not 'mimetype' in data:
-                data['mimetype'] = target_mimetype
+                data['mimetype'] = target_mimetype or renderer.mimetype
 
         data['persist'] = persist
         return data
@@ -172,7 +223,7 @@ class BasicView(GiottoView):
                 row = "<tr><td>{0}</td><td>{1}</td></tr>".format(key, v)
                 out.append(row)
 
-        env = Environment(loader=PackageLoader('giotto'))
+        env = get_jinja_environment()
         template = env.get_template('generic.html')
         rendered = template.render({'header': h1, 'table_header': header, 'table_body': out})
         return {'body': rendered, 'mimetype': 'text/html'}
@@ -211,19 +262,80 @@ class BasicView(GiottoView):
 
         return "\n".join(out)
 
-def get_jinja_template(template_name):
+jinja_environments = {}
+jinja_environments_lock = threading.Lock()
+
+def get_jinja_environment(template_path=None, undefined=None):
+    """
+    Return the jinja Environment for loading templates out of `template_path`.
+    If no path is given, the environment for giotto's own templates is returned.
+    `undefined` is the Undefined class the environment uses (partial renders use
+    DebugUndefined), each one gets a separate environment.
+    Environments are created once per process and shared, so compiled templates
+    are cached between requests. The following settings are used:
+
+        jinja_cache_size: number of compiled templates to keep (default 400)
+        jinja_bytecode_cache: a directory to store compiled templates on disk
+        jinja_auto_reload: check templates for changes on each load. Defaults
+            to the value of `debug`. Turn this off in production.
+
+    Environments are cached by these settings too, so changing them (by
+    calling `initialize` again) gets a new environment.
+    """
+    cache_size = get_config('jinja_cache_size', 400)
+    bytecode_dir = get_config('jinja_bytecode_cache')
+    auto_reload = bool(get_config('jinja_auto_reload', get_config('debug')))
+
+    key = (template_path, undefined, cache_size, bytecode_dir, auto_reload)
+    env = jinja_environments.get(key)
+    if env:
+        return env
+
+    with jinja_environments_lock:
+        env = jinja_environments.get(key)
+        if env:
+            return env
+
+        if template_path:
+            loader = FileSystemLoader(template_path)
+        else:
+            loader = PackageLoader('giotto')
+
+        bytecode_cache = bytecode_dir and FileSystemBytecodeCache(bytecode_dir)
+
+        kwargs = {'undefined': undefined} if undefined else {}
+        env = Environment(
+            loader=loader,
+            cache_size=cache_size,
+            auto_reload=auto_reload,
+            bytecode_cache=bytecode_cache or None,
+            **kwargs
+        )
+        jinja_environments[key] = env
+        return env
+
+def get_jinja_template(template_name, undefined=None):
     ppx = get_config('project_path')
-    env = Environment(loader=FileSystemLoader(os.path.join(ppx, 'views'))) 
+    env = get_jinja_environment(os.path.join(ppx, 'views'), undefined)
     return env.get_template(template_name)
 
-def jinja_template(template_name, name='data', mimetype="text/html"):
+# number of template pieces that are joined into each chunk of a streamed template
+jinja_stream_buffer = 20
+
+def jinja_template(template_name, name='data', mimetype="text/html", stream=False):
     """
-    Meta-renderer for rendering jinja templates
+    Meta-renderer for rendering jinja templates. With `stream`, the template
+    is rendered bit by bit while the response is being sent, instead of
+    all at once.
     """
     def jinja_renderer(result, errors):
         template = get_jinja_template(template_name)
         context = {name: result or Mock(), 'errors': errors, 'enumerate': enumerate}
-        rendered = template.render(**context)
+        if stream:
+            rendered = template.stream(**context)
+            rendered.enable_buffering(jinja_stream_buffer)
+        else:
+            rendered = template.render(**context)
         return {'body': rendered, 'mimetype': mimetype}
     return jinja_renderer
 
@@ -236,12 +348,9 @@ def partial_jinja_template(template_name, name='data', mimetype="text/html"):
     kept in the emplate intact.
     """
     def partial_jinja_renderer(result, errors):
-        template = get_jinja_template(template_name)
-        old = template.environment.undefined
-        template.environment.undefined = DebugUndefined
+        template = get_jinja_template(template_name, undefined=DebugUndefined)
         context = {name: result or Mock(), 'errors': errors}
         rendered = template.render(**context)
-        template.environment.undefined = old
         return {'body': rendered, 'mimetype': mimetype}
     return partial_jinja_renderer
 